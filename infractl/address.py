@@ -0,0 +1,107 @@
+import logging
+
+from .sodium import salt_call_iter, interface_ip, PRIVATE_INTERFACES
+from .cache import TTLCache
+from .config import Config
+
+cfg = Config()
+
+logger = logging.getLogger(__name__)
+
+
+def _minion_id(target):
+    # InfraInstances (and InstanceRecords) are named after their minion
+    return target if isinstance(target, str) else target.name
+
+
+class AddressResolver(object):
+    """
+    Resolves private IPs for many minions at once: every interface of every minion comes back from a single
+    network.interfaces call. Minions salt can't answer for in time (or at all) fall back to the
+    PrivateIpAddress already sitting in the EC2 payload when we were handed an InfraInstance. Results are
+    cached for cfg.address_cache_ttl seconds.
+    """
+    def __init__(self, interfaces=PRIVATE_INTERFACES, salt_timeout=None, use_salt=True, ttl=None):
+        '''
+        :param interfaces: Interface names to take the address from, in order of preference
+        :param salt_timeout: Seconds to wait on salt before falling back to EC2
+        :param use_salt: Set to False to go straight to the EC2 payload
+        :param ttl: Seconds to cache addresses for
+        '''
+        self.interfaces = interfaces
+        self.salt_timeout = salt_timeout if salt_timeout is not None else cfg.address_salt_timeout
+        self.use_salt = use_salt
+        self.cache = TTLCache(ttl=ttl if ttl is not None else cfg.address_cache_ttl, maxsize=0)
+
+    def __repr__(self):
+        return '<AddressResolver: {n} cached>'.format(n=len(self.cache))
+
+    def resolve(self, targets):
+        '''
+        :param targets: Iterable of minion ids and/or InfraInstances
+        :return: dict of minion_id -> ip (None if it couldn't be resolved)
+        '''
+        targets = dict((_minion_id(t), t) for t in targets)
+        addresses = {}
+
+        for minion_id in targets:
+            ip = self.cache.get(minion_id)
+            if ip:
+                addresses[minion_id] = ip
+
+        todo = [m for m in targets if m not in addresses]
+        if todo and self.use_salt:
+            addresses.update(self._from_salt(todo))
+
+        for minion_id in todo:
+            if addresses.get(minion_id):
+                continue
+
+            ip = getattr(targets[minion_id], 'private_ip_address', None)
+            if ip:
+                logger.debug('Using the EC2 address for %s: %s', minion_id, ip)
+            else:
+                logger.error('Unable to get the IP address for: %s', minion_id)
+            addresses[minion_id] = ip
+
+        for minion_id in todo:
+            if addresses[minion_id]:
+                self.cache.set(minion_id, addresses[minion_id])
+
+        return addresses
+
+    def resolve_one(self, target):
+        return self.resolve([target]).get(_minion_id(target))
+
+    def invalidate(self, target=None):
+        if target is None:
+            return self.cache.invalidate()
+
+        return self.cache.invalidate(key=_minion_id(target))
+
+    def _from_salt(self, minion_ids):
+        addresses = {}
+        try:
+            for minion_id, interfaces in salt_call_iter(minion_ids, 'network.interfaces', [], 'list',
+                                                        timeout=self.salt_timeout):
+                ip = interface_ip(interfaces, self.interfaces)
+                if ip:
+                    addresses[minion_id] = ip
+        except Exception as e:
+            logger.warning('Unable to resolve addresses through salt: %s', e)
+
+        return addresses
+
+
+_resolver = None
+
+
+def get_resolver():
+    '''
+    :return: The shared AddressResolver for this process
+    '''
+    global _resolver
+    if _resolver is None:
+        _resolver = AddressResolver()
+
+    return _resolver
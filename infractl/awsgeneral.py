@@ -1,66 +1,342 @@
+from .instance import get_instance, iter_instance_data
+from .sodium import get_grains
+from .exception import InfraCtlSaltException
+from .connection import get_client
+from .util import backoff_delay, chunks, fan_out
 
-from .instance import get_instance
-from .sodium import get_grain_val
-
-import boto3
+import logging
 import time
 
+logger = logging.getLogger(__name__)
+
+# create_tags accepts up to this many resource ids per call
+CREATE_TAGS_MAX_RESOURCES = 1000
+# describe_tags filter values are capped well below that
+DESCRIBE_TAGS_MAX_FILTER_VALUES = 200
+THROTTLE_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+# these are the tags we use for cost allocation.
+COST_ALLOCATION_TAGS = ('cost_center', 'classification', 'purpose', 'role', 'environment')
 
-def tag_minion(minion_id, instance_id, region):
-    # these are the tags we use for cost allocation.
+
+def tag_minion(minion_id, instance_id, region, writer=None):
     # If we don't get a value from grains for any of these, don't set the tag. I think this is more desireable than
     # tagging it with a different arbitrary value....
     # For instance: tagging mysql purpose as 'unknown' or 'undefined' is essentially grouping things into
     # an "untagged" group.
-    cost_allocation_tags = ('cost_center', 'classification', 'purpose', 'role', 'environment')
+    # When handed a writer we only enqueue; the caller flushes once for the whole batch. Our own writer looks up
+    # the root volume's current tags (the instance's we already have) so unchanged tags aren't rewritten
+    flush = writer is None
+    if writer is None:
+        writer = TagWriter(lookup_existing=True)
+
+    instance = get_instance(region, instance_id)
+    grains = get_grains([minion_id], COST_ALLOCATION_TAGS)[minion_id]
+
+    if grains is None:
+        raise InfraCtlSaltException('Unable to pull grains {g} for {m}'.format(g=COST_ALLOCATION_TAGS, m=minion_id))
 
     tags = []
 
-    for t in cost_allocation_tags:
-        val = get_grain_val(minion_id, t)
+    for t in COST_ALLOCATION_TAGS:
+        val = grains.get(t)
         if val:
             tags.append({'Key': t, 'Value': val})
 
     if tags:
         #logger.info('Tagging {}: {}'.format(minion_id, tags))
-        create_tags([instance_id], tags, region)
+        writer.add([instance_id], tags, region, current_tags={instance_id: instance.tags})
     else:
         pass
         #logger.error('NO COST ALLOCATION TAGS ARE BEING APPLIED TO THIS INSTANCE!')
 
-    tag_root_volume(minion_id, region, tags)
+    tag_root_volume(minion_id, region, tags, instance=instance, writer=writer)
+
+    if flush:
+        return writer.flush()
 
 
-def tag_root_volume(minion_id, region, tags, device='/dev/sda1'):
-    filters = [
-        {
-            'Name': 'tag:Name',
-            'Values': [minion_id]
-        }
-    ]
-    instance = get_instance(region, filters=filters)
+def tag_root_volume(minion_id, region, tags, device='/dev/sda1', instance=None, writer=None):
+    if instance is None:
+        filters = [
+            {
+                'Name': 'tag:Name',
+                'Values': [minion_id]
+            }
+        ]
+        instance = get_instance(region, filters=filters)
 
-    tags.append({'Key': 'purpose', 'Value': 'root-volume'})
+    tags = tags + [{'Key': 'purpose', 'Value': 'root-volume'}]
 
-    for b in instance.ec2Instance.block_device_mappings:
+    flush = writer is None
+    if writer is None:
+        writer = TagWriter(lookup_existing=True)
+
+    for b in instance.block_device_mappings:
         if b['DeviceName'] == device:
-            create_tags([b['Ebs']['VolumeId']], tags, region)
+            writer.add([b['Ebs']['VolumeId']], tags, region)
+
+    if flush:
+        return writer.flush()
+
+
+def reconcile_cost_tags(regions, minion_grains=None, dry_run=False, max_workers=None):
+    '''
+    Bring the cost allocation tags on every instance, and every volume attached to it, in line with the
+    minions' grains. Per region this is a couple of paginated describe calls, grains for every minion come
+    from a single salt call, and only tags that actually differ are written (through one TagWriter flush).
+
+    Instances are matched to minions by their Name tag. The root volume (the instance's RootDeviceName,
+    whatever it is) additionally gets purpose=root-volume, same as tag_root_volume does.
+
+    :param regions: List of region names
+    :param minion_grains: Optional dict of minion_id -> {grain: value}. Fetched from salt if not given
+    :param dry_run: Only compute the changes
+    :param max_workers: Max number of regions queried at once
+    :return: dict report with the changes (and the flush result unless dry_run)
+    '''
+    report = {'instances': 0, 'volumes': 0, 'changes': [], 'failed_regions': {}}
+    writer = TagWriter()
+    inventories = {}
+
+    for region, inventory, error in fan_out(regions, _tag_inventory, max_workers=max_workers):
+        if error is not None:
+            logger.error('Unable to reconcile tags in %s: %s', region, error)
+            report['failed_regions'][region] = str(error)
+            continue
+
+        inventories[region] = inventory
+
+    if minion_grains is None:
+        names = set()
+        for instances, _ in inventories.values():
+            names.update(_tag_dict(i.get('Tags')).get('Name') for i in instances)
+        names.discard(None)
+
+        minion_grains = get_grains(sorted(names), COST_ALLOCATION_TAGS)
+
+    for region, (instances, volume_tags) in inventories.items():
+        for data in instances:
+            current = _tag_dict(data.get('Tags'))
+            minion_id = current.get('Name')
+            grains = minion_grains.get(minion_id)
+
+            if not grains:
+                continue
+
+            desired = dict((t, grains[t]) for t in COST_ALLOCATION_TAGS if grains.get(t))
+            if not desired:
+                logger.warning('No cost allocation grains for %s', minion_id)
+                continue
+
+            report['instances'] += 1
+            changes = [(data['InstanceId'], desired, current)]
+
+            for b in data.get('BlockDeviceMappings') or []:
+                volume_id = (b.get('Ebs') or {}).get('VolumeId')
+                if not volume_id:
+                    continue
+
+                vol_desired = dict(desired)
+                if b.get('DeviceName') == data.get('RootDeviceName'):
+                    vol_desired['purpose'] = 'root-volume'
+
+                report['volumes'] += 1
+                changes.append((volume_id, vol_desired, volume_tags.get(volume_id, {})))
+
+            for resource_id, want, have in changes:
+                diff = dict((k, v) for k, v in want.items() if have.get(k) != v)
+                if not diff:
+                    continue
+
+                report['changes'].append({'region': region, 'minion': minion_id,
+                                          'resource_id': resource_id, 'tags': diff})
+                writer.add([resource_id], diff, region)
+
+    logger.info('%d instance(s), %d volume(s) checked, %d resource(s) need tags',
+                report['instances'], report['volumes'], len(report['changes']))
+
+    if not dry_run:
+        report['result'] = writer.flush()
+
+    return report
+
+
+def _tag_inventory(region):
+    client = get_client('ec2', region)
+    instances = list(iter_instance_data(client))
+
+    volume_tags = {}
+    paginator = client.get_paginator('describe_volumes')
+    for page in paginator.paginate(Filters=[{'Name': 'attachment.status', 'Values': ['attached']}]):
+        for v in page.get('Volumes', []):
+            volume_tags[v['VolumeId']] = _tag_dict(v.get('Tags'))
+
+    return instances, volume_tags
+
+
+def _error_code(e):
+    try:
+        return e.response['Error']['Code']
+    except (AttributeError, KeyError, TypeError):
+        return None
 
 
 def create_tags(entity_ids, tags, region, retry=3, sleep=1):
     counter = 1
     #logger.info("Tagging resource {0} with {1}".format(entity_ids, tags))
+    b3c = get_client('ec2', region)
     while True:
         counter += 1
         try:
-            b3c = boto3.client('ec2', region)
             b3c.create_tags(Resources=entity_ids, Tags=tags)
             return
         except Exception as e:
             if counter <= retry:
-                time.sleep(sleep)
+                # back off harder when AWS is telling us to slow down
+                if _error_code(e) in THROTTLE_ERROR_CODES:
+                    time.sleep(backoff_delay(counter - 2, base=sleep))
+                else:
+                    time.sleep(sleep)
                 continue
             else:
                 #logger.error('Unable to tag {} with tags {}'.format(entity_ids, tags))
                 #logger.error(e)
-                return False
\ No newline at end of file
+                return False
+
+
+class TagWriter(object):
+    """
+    Collects tag writes and flushes them in as few create_tags calls as possible: resources that end up
+    with an identical set of tags (per region) are written together, up to CREATE_TAGS_MAX_RESOURCES at a
+    time. Tags a resource already carries are dropped before anything is sent. Throttling slows the whole
+    writer down (and it speeds back up as calls succeed) rather than just retrying the one call.
+    """
+    def __init__(self, lookup_existing=False, retry=5, base_delay=1, max_delay=30):
+        '''
+        :param lookup_existing: For resources added without current_tags, look their tags up (one
+            describe_tags per region per chunk of ids) at flush time so unchanged tags aren't rewritten
+        :param retry: Attempts per create_tags call before giving up on it
+        :param base_delay: Starting delay in seconds once throttled
+        :param max_delay: Upper bound on the delay between calls
+        '''
+        self.lookup_existing = lookup_existing
+        self.retry = retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.pace = 0
+
+        # region -> resource_id -> {key: value} still to be written
+        self.pending = {}
+        # region -> resource ids we were told the current tags for
+        self.known = {}
+
+    def __repr__(self):
+        return '<TagWriter: {n} resource(s) pending>'.format(n=sum(len(r) for r in self.pending.values()))
+
+    def add(self, resource_ids, tags, region, current_tags=None):
+        '''
+        Queue tags for some resources
+        :param resource_ids: List of AWS resource ids
+        :param tags: List of {'Key': ..., 'Value': ...} dicts (or a plain dict). Later keys win
+        :param region: String region name
+        :param current_tags: Optional dict of resource_id -> tags the resource already has, in either form
+        '''
+        wanted = _tag_dict(tags)
+        current_tags = current_tags or {}
+        pending = self.pending.setdefault(region, {})
+        known = self.known.setdefault(region, set())
+
+        for rid in resource_ids:
+            desired = pending.setdefault(rid, {})
+            desired.update(wanted)
+
+            if rid in current_tags:
+                known.add(rid)
+                _drop_present(desired, _tag_dict(current_tags[rid]))
+
+            if not desired:
+                del pending[rid]
+
+    def flush(self):
+        '''
+        Write everything queued
+        :return: dict with the number of create_tags calls made, resources tagged and failed resource ids
+        '''
+        report = {'calls': 0, 'tagged': 0, 'failed': []}
+
+        for region, pending in self.pending.items():
+            if self.lookup_existing:
+                self._drop_existing(region, pending)
+
+            groups = {}
+            for rid, desired in pending.items():
+                if desired:
+                    groups.setdefault(tuple(sorted(desired.items())), []).append(rid)
+
+            for tag_set, resource_ids in groups.items():
+                tags = [{'Key': k, 'Value': v} for k, v in tag_set]
+                for chunk in chunks(sorted(resource_ids), CREATE_TAGS_MAX_RESOURCES):
+                    report['calls'] += 1
+                    if self._create_tags(region, chunk, tags):
+                        report['tagged'] += len(chunk)
+                    else:
+                        report['failed'].extend(chunk)
+
+        self.pending = {}
+        self.known = {}
+
+        logger.debug('Tag flush: %s', report)
+        return report
+
+    def _drop_existing(self, region, pending):
+        unknown = [rid for rid in pending if rid not in self.known.get(region, ())]
+        client = get_client('ec2', region)
+
+        for chunk in chunks(unknown, DESCRIBE_TAGS_MAX_FILTER_VALUES):
+            current = {}
+            paginator = client.get_paginator('describe_tags')
+            for page in paginator.paginate(Filters=[{'Name': 'resource-id', 'Values': chunk}]):
+                for t in page.get('Tags', []):
+                    current.setdefault(t['ResourceId'], {})[t['Key']] = t['Value']
+
+            for rid in chunk:
+                _drop_present(pending[rid], current.get(rid, {}))
+
+    def _create_tags(self, region, resource_ids, tags):
+        client = get_client('ec2', region)
+
+        for attempt in range(self.retry):
+            if self.pace:
+                time.sleep(self.pace)
+
+            try:
+                client.create_tags(Resources=resource_ids, Tags=tags)
+            except Exception as e:
+                if _error_code(e) in THROTTLE_ERROR_CODES:
+                    self.pace = min(self.max_delay, max(self.base_delay, self.pace * 2))
+                    logger.warning('Throttled tagging in %s, slowing to one call per %.1fs', region, self.pace)
+                else:
+                    logger.warning('Unable to tag %d resource(s) in %s: %s', len(resource_ids), region, e)
+                    time.sleep(backoff_delay(attempt, base=self.base_delay, cap=self.max_delay))
+                continue
+
+            # ease back off once calls go through again
+            self.pace = self.pace / 2.0 if self.pace > self.base_delay else 0
+            return True
+
+        logger.error('Unable to tag %s with tags %s', resource_ids, tags)
+        return False
+
+
+def _tag_dict(tags):
+    if isinstance(tags, dict):
+        return dict(tags)
+
+    return dict((t['Key'], t['Value']) for t in tags or [])
+
+
+def _drop_present(desired, current):
+    for k, v in list(desired.items()):
+        if current.get(k) == v:
+            del desired[k]
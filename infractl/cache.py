@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    """
+    A small thread safe LRU cache whose entries also expire after ttl seconds. Keys must be strings and
+    values json serializable if a path is given - the cache is then loaded from and written back to that
+    file so separate processes (i.e. repeated CLI runs) share results.
+    """
+    def __init__(self, ttl=300, maxsize=1024, path=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.path = os.path.expanduser(path) if path else None
+
+        self._lock = threading.RLock()
+        self._data = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+        self._load()
+
+    def __repr__(self):
+        return '<TTLCache: {n}/{m} entries, ttl {t}s>'.format(n=len(self._data), m=self.maxsize, t=self.ttl)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return default
+
+            stored_at, value = entry
+            if self.ttl and time.time() - stored_at > self.ttl:
+                del self._data[key]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+
+            while self.maxsize and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats['evicted'] += 1
+
+            self._save()
+
+    def invalidate(self, key=None, predicate=None):
+        '''
+        Drop one key, every entry predicate(key, value) is true for, or (with neither) everything
+        :return: Number of entries dropped
+        '''
+        with self._lock:
+            if key is None and predicate is None:
+                dropped = list(self._data)
+            elif key is not None:
+                dropped = [key] if key in self._data else []
+            else:
+                dropped = [k for k, (_, v) in self._data.items() if predicate(k, v)]
+
+            for k in dropped:
+                del self._data[k]
+
+            if dropped:
+                self._save()
+
+            return len(dropped)
+
+    def _load(self):
+        if not self.path:
+            return
+
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        now = time.time()
+        for key, stored_at, value in entries:
+            if self.ttl and now - stored_at > self.ttl:
+                continue
+            self._data[key] = (stored_at, value)
+
+    def _save(self):
+        if not self.path:
+            return
+
+        tmp = '{p}.{pid}'.format(p=self.path, pid=os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+
+            with open(tmp, 'w') as f:
+                json.dump([[k, t, v] for k, (t, v) in self._data.items()], f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            logger.warning('Unable to write cache %s: %s', self.path, e)
@@ -3,9 +3,38 @@
 class Config(object):
     def __init__(self):
         self.instance_meta_url = None
+        self.instance_meta_connect_timeout = None
+        self.instance_meta_read_timeout = None
+        self.instance_meta_token_ttl = None
+        self.instance_meta_cache = None
+        self.instance_meta_cache_ttl = None
         self.tld = None
         self.boto_profile = None
         self.treat_salt_master_as_minion = None
+        self.instance_ttl = None
+        self.salt_cache_ttl = None
+        self.salt_cache_size = None
+        self.salt_cache_path = None
+        self.salt_transport = None
+        self.salt_job_timeout = None
+        self.address_cache_ttl = None
+        self.address_salt_timeout = None
+        self.target_timeout = None
+        self.grain_index_ttl = None
+        self.grain_index_path = None
+        self.ssh_keepalive = None
+        self.ssh_pool_max_connections = None
+        self.ssh_pool_idle_timeout = None
+        self.ssh_pool_wait_timeout = None
+        self.fleet_concurrency = None
+        self.fleet_connect_timeout = None
+        self.fleet_cmd_timeout = None
+        self.fleet_max_output = None
+        self.sftp_workers = None
+        self.sftp_buffer_size = None
+        self.sftp_chunk_size = None
+        self.sftp_journal_dir = None
+        self.progress_interval = None
 
         self.clean_ssh = {
             'stdout': None,
@@ -16,10 +45,67 @@ class Config(object):
 
     def __set_defaults(self):
         self.instance_meta_url = 'http://169.254.169.254/latest/dynamic/instance-identity/document'
+        self.instance_meta_connect_timeout = 0.5
+        self.instance_meta_read_timeout = 2
+        self.instance_meta_token_ttl = 21600
+        # Set to None to disable the on-disk copy of the identity document
+        self.instance_meta_cache = '~/.cache/infractl/identity.json'
+        self.instance_meta_cache_ttl = 86400
         self.tld = 'aws.amazon.com'
         self.boto_profile = 'ro-user'
         self.treat_salt_master_as_minion = True
 
+        # Seconds an InfraInstance's data is considered fresh (reload() is a no-op in that window)
+        self.instance_ttl = 30
+
+        # Memoization of salt_call results. Set salt_cache_ttl to 0 to disable, and point salt_cache_path
+        # somewhere (e.g. ~/.cache/infractl/salt.json) to share results between runs
+        self.salt_cache_ttl = 300
+        self.salt_cache_size = 1024
+        self.salt_cache_path = None
+
+        # How sodium reaches salt: 'subprocess' (the salt CLI), 'local' (in-process LocalClient, masters only),
+        # 'caller' (in-process Caller + publish.publish, minions) or 'auto'
+        self.salt_transport = 'subprocess'
+        # Seconds an async salt job (SaltJobs) is given to finish
+        self.salt_job_timeout = 60
+
+        # AddressResolver: how long resolved IPs are kept, and how long salt gets before we fall back to EC2
+        self.address_cache_ttl = 600
+        self.address_salt_timeout = 10
+
+        # Seconds TargetResolver waits for salt or EC2 to answer
+        self.target_timeout = 15
+
+        # GrainIndex: seconds before a refresh is considered stale, and an optional file to share it between runs
+        self.grain_index_ttl = 900
+        self.grain_index_path = None
+
+        # SshConnectionPool: keepalive interval, max connections held, seconds before an idle connection is
+        # closed, and seconds to wait for a free slot when the pool is full
+        self.ssh_keepalive = 30
+        self.ssh_pool_max_connections = 64
+        self.ssh_pool_idle_timeout = 300
+        self.ssh_pool_wait_timeout = 30
+
+        # FleetExecutor defaults
+        self.fleet_concurrency = 25
+        self.fleet_connect_timeout = 5
+        self.fleet_cmd_timeout = 300
+        # bytes of stdout/stderr kept per host
+        self.fleet_max_output = 1048576
+
+        # InfraCtlSFTPClient.upload: concurrent SFTP channels per host and the size of each pipelined write
+        self.sftp_workers = 8
+        self.sftp_buffer_size = 262144
+
+        # InfraCtlSFTPClient.put_large: size of the ranges sent concurrently, and where resume journals live
+        self.sftp_chunk_size = 67108864
+        self.sftp_journal_dir = '~/.cache/infractl/transfers'
+
+        # Seconds between progress.TransferProgress reports
+        self.progress_interval = 5
+
         self.clean_ssh = {
             'stdout': True,
             'stderr': True
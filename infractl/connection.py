@@ -6,10 +6,18 @@ ro-user
 
 ==== REQUIRED RESOURCES/METHODS TO SUPPORT ====
 ec2 describe_instances
+
+Every module should get its boto3 clients/resources from get_client/get_resource rather than calling
+boto3.client/boto3.resource directly. Clients are expensive to build (tens of milliseconds and a pile of
+endpoint JSON each time), so they're pooled by (profile, region, service).
+
+boto3 clients are thread safe and are shared across threads. Sessions and resources are not - sessions are
+only ever touched while holding the pool lock, and resources are pooled per thread.
 '''
 
 import boto3
 import logging
+import threading
 
 from .config import Config
 cfg = Config()
@@ -20,6 +28,20 @@ AVAILABLE_PROFILES = (
     'ro-user',
 )
 
+_profile = None
+_lock = threading.RLock()
+_local = threading.local()
+_sessions = {}
+_clients = {}
+_stats = {
+    'session_hits': 0,
+    'session_misses': 0,
+    'client_hits': 0,
+    'client_misses': 0,
+    'resource_hits': 0,
+    'resource_misses': 0,
+}
+
 
 def setSessionProfile(profile_name=None):
 
@@ -32,9 +54,109 @@ def setSessionProfile(profile_name=None):
         else:
             return cfg.boto_profile
 
+    global _profile
     profile_name = get_profile(profile_name)
 
     logger.debug('Using profile: %s', profile_name)
 
-    boto3.setup_default_session(profile_name=profile_name)
+    with _lock:
+        _profile = profile_name
+
+
+def get_session(profile=None):
+    '''
+    Return the pooled boto3 Session for a profile. Sessions are not thread safe; only use the
+    returned session while holding nothing else in flight on it (get_client/get_resource handle this).
+    :param profile: boto profile name. Defaults to whatever setSessionProfile picked
+    :return: boto3.session.Session
+    '''
+    profile = profile or _profile
+
+    with _lock:
+        session = _sessions.get(profile)
+        if session is None:
+            _stats['session_misses'] += 1
+            session = boto3.session.Session(profile_name=profile)
+            _sessions[profile] = session
+        else:
+            _stats['session_hits'] += 1
+
+    return session
+
+
+def get_client(service, region=None, profile=None):
+    '''
+    Return a pooled boto3 client, shared by every thread
+    :param service: String service name (ec2, s3, ...)
+    :param region: String region name
+    :param profile: boto profile name. Defaults to whatever setSessionProfile picked
+    :return: boto3 client
+    '''
+    profile = profile or _profile
+    key = (profile, region, service)
+
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            _stats['client_hits'] += 1
+            return client
+
+        _stats['client_misses'] += 1
+        client = get_session(profile).client(service, region_name=region)
+        _clients[key] = client
+
+    return client
+
+
+def get_resource(service, region=None, profile=None):
+    '''
+    Return a boto3 resource, pooled per thread (resources are not thread safe)
+    :param service: String service name (ec2, s3, ...)
+    :param region: String region name
+    :param profile: boto profile name. Defaults to whatever setSessionProfile picked
+    :return: boto3 resource
+    '''
+    profile = profile or _profile
+    key = (profile, region, service)
+
+    resources = getattr(_local, 'resources', None)
+    if resources is None:
+        resources = _local.resources = {}
+
+    resource = resources.get(key)
+    if resource is not None:
+        with _lock:
+            _stats['resource_hits'] += 1
+        return resource
+
+    with _lock:
+        _stats['resource_misses'] += 1
+        resource = get_session(profile).resource(service, region_name=region)
+
+    resources[key] = resource
+    return resource
+
+
+def pool_stats():
+    '''
+    :return: dict of hit/miss counters for sessions, clients and resources plus the current pool sizes
+    '''
+    with _lock:
+        stats = dict(_stats)
+        stats['sessions'] = len(_sessions)
+        stats['clients'] = len(_clients)
+
+    return stats
+
+
+def reset_pool():
+    '''
+    Drop every pooled session and client (this thread's resources included) and zero the counters
+    '''
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+        for k in _stats:
+            _stats[k] = 0
 
+    _local.resources = {}
@@ -30,3 +30,19 @@ class InfraCtlSaltException(InfraCtlException):
 
 class InfraCtlInstanceException(InfraCtlException):
     pass
+
+
+class InfraCtlTimeoutException(InfraCtlException):
+    pass
+
+
+class InfraCtlRegionException(InfraCtlAWSException):
+    """
+    Raised when one or more regions failed during a multi-region query. Whatever did come back is kept on
+    the exception so callers can still use the partial result.
+    """
+
+    def __init__(self, msg='', results=None, failures=None):
+        super(InfraCtlRegionException, self).__init__(msg)
+        self.results = results if results is not None else []
+        self.failures = failures or {}
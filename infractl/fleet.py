@@ -0,0 +1,185 @@
+import logging
+import threading
+import time
+
+from .ssh import InfraCtlSshClient
+from .sshpool import SshConnectionPool
+from .address import get_resolver
+from .util import fan_out
+from .config import Config
+
+cfg = Config()
+
+logger = logging.getLogger(__name__)
+
+
+class FleetExecutor(object):
+    """
+    Runs a command across any number of InfraInstances with bounded concurrency, streaming results back in
+    the order hosts finish. Each result is the same {'exit_code', 'msg'} dict InfraCtlSshClient.cmd returns
+    plus a 'timing' dict (connect, cmd and total seconds). Connections come from a SshConnectionPool, so
+    running several commands against the same fleet only pays the handshake once per host. Unless a pool is
+    handed in, the executor owns a pool sized for its concurrency; close() it (or use it as a context manager)
+    when done.
+
+        with FleetExecutor(concurrency=50) as fleet:
+            for instance, res in fleet.run(instances, 'uptime'):
+                ...
+
+    With fail_fast, the first host that fails (can't connect, times out, or exits non-zero) stops anything
+    not yet started. Afterwards self.skipped holds the hosts that never ran the command, and self.in_flight
+    the ones that had already started it and weren't waited on - they may well still be running it.
+    """
+    def __init__(self, user='root', keyfile='/root/.ssh/id_rsa', concurrency=None, connect_timeout=None,
+                 cmd_timeout=None, fail_fast=False, pool=None, use_ip=False, max_bytes=None):
+        '''
+        :param concurrency: Max hosts worked on at once
+        :param connect_timeout: Seconds allowed for the SSH connect (only applies to the executor's own pool)
+        :param cmd_timeout: Seconds allowed for the command itself
+        :param fail_fast: Stop at the first failed host
+        :param pool: SshConnectionPool to draw connections from instead of a private one. It's left open by
+            close() and should hold at least concurrency connections
+        :param use_ip: Connect to the instances' private IPs (resolved in bulk up front) instead of their
+            hostnames
+        :param max_bytes: Most stdout/stderr kept per host (cfg.fleet_max_output)
+        '''
+        self.user = user
+        self.keyfile = keyfile
+        self.concurrency = concurrency or cfg.fleet_concurrency
+        self.connect_timeout = connect_timeout if connect_timeout is not None else cfg.fleet_connect_timeout
+        self.cmd_timeout = cmd_timeout if cmd_timeout is not None else cfg.fleet_cmd_timeout
+        self.fail_fast = fail_fast
+        self.use_ip = use_ip
+        self.max_bytes = max_bytes if max_bytes is not None else cfg.fleet_max_output
+
+        self.own_pool = pool is None
+        if pool is None:
+            pool = SshConnectionPool(max_connections=self.concurrency, connect_timeout=self.connect_timeout)
+        elif pool.max_connections < self.concurrency:
+            logger.warning('%s holds fewer connections than %d hosts at once, some hosts will wait on it', pool,
+                           self.concurrency)
+        self.pool = pool
+
+        self.skipped = []
+        self.in_flight = []
+
+        self._lock = threading.Lock()
+        self._started = set()
+        self._stopped = False
+
+    def __repr__(self):
+        return '<FleetExecutor: {u}, {n} at a time>'.format(u=self.user, n=self.concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''
+        Close the executor's own pool (a pool that was handed in is left alone)
+        '''
+        if self.own_pool:
+            self.pool.close()
+
+    def _run_one(self, instance, cmd, address=None):
+        with self._lock:
+            if self._stopped:
+                return None
+            self._started.add(id(instance))
+
+        start = time.time()
+        client = InfraCtlSshClient(instance, user=self.user, keyfile=self.keyfile, pool=self.pool, address=address)
+        client.connect()
+        connected = time.time()
+
+        if not client.client:
+            res = {
+                'exit_code': 255,
+                'msg': {
+                    'stdout': '',
+                    'stderr': 'Unable to connect to {h}'.format(h=client.host)
+                }
+            }
+        else:
+            try:
+                res = client.cmd(cmd, timeout=self.cmd_timeout, max_bytes=self.max_bytes)
+            finally:
+                client.close()
+
+        done = time.time()
+        res['timing'] = {
+            'connect': connected - start,
+            'cmd': done - connected,
+            'total': done - start,
+        }
+
+        return res
+
+    def run(self, instances, cmd):
+        '''
+        :param instances: Iterable of InfraInstances
+        :param cmd: String command to run on every host
+        :return: generator of (instance, result) in completion order
+        '''
+        instances = list(instances)
+        pending = dict((id(i), i) for i in instances)
+        self.skipped = []
+        self.in_flight = []
+        self._started = set()
+        self._stopped = False
+
+        addresses = {}
+        if self.use_ip:
+            addresses = get_resolver().resolve(instances)
+
+        # backstop in case a host wedges somewhere neither timeout covers
+        timeout = None
+        if self.cmd_timeout:
+            timeout = self.connect_timeout + self.cmd_timeout + 30
+
+        results = fan_out(instances, lambda i: self._run_one(i, cmd, addresses.get(i.name)),
+                          max_workers=self.concurrency, timeout=timeout)
+
+        try:
+            for instance, res, error in results:
+                del pending[id(instance)]
+
+                if error is not None:
+                    res = {
+                        'exit_code': 255,
+                        'msg': {
+                            'stdout': '',
+                            'stderr': str(error)
+                        },
+                        'timing': {}
+                    }
+
+                if res['exit_code'] != 0:
+                    logger.warning('%s: exit %s', instance, res['exit_code'])
+
+                yield instance, res
+
+                if self.fail_fast and res['exit_code'] != 0:
+                    break
+        finally:
+            # nothing starts once _stopped is set, so _started is final from here on
+            with self._lock:
+                self._stopped = True
+                started = set(self._started)
+            results.close()
+
+            self.skipped = [i for key, i in pending.items() if key not in started]
+            self.in_flight = [i for key, i in pending.items() if key in started]
+
+            if self.skipped or self.in_flight:
+                logger.error('Stopped early: %d host(s) not run, %d still running and not waited on: %s',
+                             len(self.skipped), len(self.in_flight), ', '.join(str(i) for i in self.in_flight) or '-')
+
+    def run_all(self, instances, cmd):
+        '''
+        Blocking form of run
+        :return: List of (instance, result) in completion order
+        '''
+        return list(self.run(instances, cmd))
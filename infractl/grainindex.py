@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from .sodium import salt_call_iter
+from .saltclient import get_transport
+from .config import Config
+
+cfg = Config()
+
+logger = logging.getLogger(__name__)
+
+
+def _values(val):
+    # Index scalars and the members of list grains (roles: [web, worker]); anything nested isn't targetable
+    if isinstance(val, (list, tuple, set)):
+        return [str(v) for v in val if not isinstance(v, (dict, list, tuple, set))]
+    if isinstance(val, dict) or val is None:
+        return []
+
+    return [str(val)]
+
+
+class GrainIndex(object):
+    """
+    A local copy of the fleet's grains with an inverted index (grain -> value -> minions), so selectors can be
+    answered in memory instead of publishing to the master. Selectors are dicts of grain -> value or list of
+    values and match with OR within a grain and AND across grains:
+
+        index.match({'role': ['web', 'api'], 'environment': 'prod'})
+
+    Refresh it in bulk from grains.items (or the salt mine); minions are updated incrementally, so only the
+    ones that actually changed touch the index. It's considered stale ttl seconds after the last refresh and
+    can be persisted to disk so separate runs share it.
+    """
+    def __init__(self, grains=None, ttl=None, path=None):
+        '''
+        :param grains: Only index these grains (default: everything grains.items returns)
+        :param ttl: Seconds after a refresh before the index is stale
+        :param path: Optional json file to load from / save to
+        '''
+        self.grains = list(grains) if grains else None
+        self.ttl = ttl if ttl is not None else cfg.grain_index_ttl
+        self.path = os.path.expanduser(path or cfg.grain_index_path or '') or None
+
+        self._lock = threading.RLock()
+        self._refresher = None
+        self.minions = {}
+        self.index = {}
+        self.refreshed_at = 0
+
+        self.load()
+
+    def __repr__(self):
+        return '<GrainIndex: {n} minion(s), {g} grain(s)>'.format(n=len(self.minions), g=len(self.index))
+
+    def is_stale(self):
+        return not self.refreshed_at or (self.ttl and time.time() - self.refreshed_at > self.ttl)
+
+    def update_minion(self, minion_id, grains):
+        '''
+        Replace what we know about one minion
+        :return: True if anything changed
+        '''
+        if self.grains is not None:
+            grains = dict((g, grains.get(g)) for g in self.grains if g in grains)
+
+        with self._lock:
+            old = self.minions.get(minion_id)
+            if old == grains:
+                return False
+
+            if old is not None:
+                self._unindex(minion_id, old)
+
+            self.minions[minion_id] = grains
+            for g, val in grains.items():
+                for v in _values(val):
+                    self.index.setdefault(g, {}).setdefault(v, set()).add(minion_id)
+
+            return True
+
+    def remove_minion(self, minion_id):
+        with self._lock:
+            old = self.minions.pop(minion_id, None)
+            if old is not None:
+                self._unindex(minion_id, old)
+
+    def _unindex(self, minion_id, grains):
+        for g, val in grains.items():
+            for v in _values(val):
+                members = self.index.get(g, {}).get(v)
+                if members is None:
+                    continue
+
+                members.discard(minion_id)
+                if not members:
+                    del self.index[g][v]
+            if g in self.index and not self.index[g]:
+                del self.index[g]
+
+    def match(self, selector):
+        '''
+        :param selector: dict of grain -> value or list of values
+        :return: set of matching minion ids
+        '''
+        with self._lock:
+            matched = None
+            for g, wanted in selector.items():
+                values = self.index.get(g, {})
+                members = set()
+                for v in _values(wanted):
+                    members |= values.get(v, set())
+
+                matched = members if matched is None else matched & members
+                if not matched:
+                    return set()
+
+            return set(self.minions) if matched is None else matched
+
+    def refresh(self, target='*', source='grains', timeout=None, prune=False):
+        '''
+        Pull grains for every minion in one bulk call and fold them in
+        :param target: glob of minions to refresh
+        :param source: 'grains' (grains.items / grains.item from the minions) or 'mine' (mine.get of
+            grains.items, answered by the master's mine data)
+        :param timeout: Seconds to wait on salt
+        :param prune: Drop minions that didn't answer (only sensible for a '*' target)
+        :return: dict with the number of minions seen and changed, and whether the index is now 'fresh'.
+            A refresh where salt timed out or nobody answered leaves the index stale (and unpruned) so callers
+            keep going to the master instead of trusting an empty index
+        '''
+        if source == 'mine':
+            returns = get_transport('caller').caller.cmd('mine.get', target, 'grains.items') or {}
+            returns = returns.items()
+        elif self.grains is not None:
+            returns = salt_call_iter(target, 'grains.item', self.grains, 'glob', timeout=timeout)
+        else:
+            returns = salt_call_iter(target, 'grains.items', [], 'glob', timeout=timeout)
+
+        seen = set()
+        changed = 0
+        for minion_id, grains in returns:
+            if not isinstance(grains, dict):
+                continue
+
+            seen.add(minion_id)
+            if self.update_minion(minion_id, grains):
+                changed += 1
+
+        timed_out = getattr(returns, 'timed_out', False)
+        if timed_out or not seen:
+            logger.warning('Grain index refresh incomplete (%d minion(s) seen%s), leaving it stale', len(seen),
+                           ', salt timed out' if timed_out else '')
+            return {'seen': len(seen), 'changed': changed, 'fresh': False}
+
+        if prune:
+            for minion_id in set(self.minions) - seen:
+                self.remove_minion(minion_id)
+
+        self.refreshed_at = time.time()
+        self.save()
+
+        logger.info('Grain index refreshed: %d minion(s) seen, %d changed', len(seen), changed)
+        return {'seen': len(seen), 'changed': changed, 'fresh': True}
+
+    def refresh_in_background(self, **kwargs):
+        '''
+        Start refresh(**kwargs) on a daemon thread, unless one is already running
+        :return: The thread, or None if a refresh was already in progress
+        '''
+        with self._lock:
+            if self._refresher is not None and self._refresher.is_alive():
+                return None
+
+            def run():
+                try:
+                    self.refresh(**kwargs)
+                except Exception as e:
+                    logger.warning('Background grain index refresh failed: %s', e)
+
+            self._refresher = threading.Thread(target=run, name='grain-index-refresh')
+            self._refresher.daemon = True
+            self._refresher.start()
+
+            return self._refresher
+
+    def load(self):
+        if not self.path:
+            return
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        for minion_id, grains in data.get('minions', {}).items():
+            self.update_minion(minion_id, grains)
+        self.refreshed_at = data.get('refreshed_at', 0)
+
+    def save(self):
+        if not self.path:
+            return
+
+        tmp = '{p}.{pid}'.format(p=self.path, pid=os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+
+            with self._lock, open(tmp, 'w') as f:
+                json.dump({'refreshed_at': self.refreshed_at, 'minions': self.minions}, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            logger.warning('Unable to write grain index %s: %s', self.path, e)
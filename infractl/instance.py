@@ -1,11 +1,13 @@
-import boto3
 import logging
 import time
-import requests
-import json
 import sys
+import threading
+import weakref
 
-from .exception import InfraCtlInstanceException
+from .exception import InfraCtlInstanceException, InfraCtlRegionException
+from .util import fan_out, backoff_delay, chunks
+from .connection import get_client, get_resource
+from .metadata import get_identity
 from .config import Config
 
 cfg = Config()
@@ -14,133 +16,530 @@ logger = logging.getLogger(__name__)
 
 INSTANCE_LIFECYCLE_STATES = ('pending', 'running', 'stopping', 'stopped', 'shutting-down', 'terminated')
 
+# Max instance ids we hand to a single describe_instances/start/stop call
+INSTANCE_ID_CHUNK = 200
+
+# (region, instance_id) -> InfraInstance. Weak, so instances nobody holds on to fall out on their own.
+_identity_map = weakref.WeakValueDictionary()
+_identity_lock = threading.Lock()
+
+
+def _hydrate(region, data, use_resource=False):
+    '''
+    Return the shared InfraInstance for a describe_instances payload, refreshing it with the new data if
+    we've already handed one out for this (region, instance_id)
+    '''
+    key = (region, data['InstanceId'])
+
+    with _identity_lock:
+        instance = _identity_map.get(key)
+        if instance is None:
+            instance = InfraInstance(region, data['InstanceId'], data=data, use_resource=use_resource)
+            _identity_map[key] = instance
+            return instance
+
+    instance.update(data)
+    if use_resource:
+        instance.attach_resource()
+    return instance
+
+
+def clear_instance_cache():
+    '''
+    Forget every shared InfraInstance. Objects already handed out keep working, they just stop being shared.
+    '''
+    with _identity_lock:
+        _identity_map.clear()
+
 # Meant to load up a InfraInstance object based on the host this is running on
 def load_self():
-    headers = {'Content-Type': 'application/json'}
-    resp = requests.get(cfg.instance_meta_url, headers=headers, timeout=3)
+    identity = get_identity()
 
-    if resp.status_code not in ('200', '204'):
+    if not identity:
         logger.error('Unable to query aws for metadata')
         return False
 
-    try:
-        metadata = json.loads(resp.text)
-    except ValueError:
-        logger.error('Unable to load response.text as json')
-        logger.debug(resp.text)
-        return False
+    return get_instance(identity.get('region', ''), identity.get('instanceId', ''))
 
-    return InfraInstance(metadata.get('region', ''), metadata.get('instanceId', ''))
+
+# Meant to walk every page of a describe_instances call, yielding the raw instance payloads
+def iter_instance_data(client, filters=None, instance_ids=None, page_size=None):
+    '''
+    Yield raw instance dicts from describe_instances, following every page of results.
+    A single un-paginated call silently truncates large accounts.
+    :param client: boto3 ec2 client
+    :param filters: AWS boto3 filters
+    :param instance_ids: List of AWS Instance IDs
+    :param page_size: Optional page size to hand to the paginator
+    :return: generator of instance dicts
+    '''
+    kwargs = {}
+    if filters:
+        kwargs['Filters'] = filters
+    if instance_ids:
+        kwargs['InstanceIds'] = list(instance_ids)
+    if page_size:
+        kwargs['PaginationConfig'] = {'PageSize': page_size}
+
+    paginator = client.get_paginator('describe_instances')
+    for page in paginator.paginate(**kwargs):
+        for reservation in page.get('Reservations', []):
+            for i in reservation.get('Instances', []):
+                yield i
 
 
 # Meant to find a single instance in a targeted region
-def get_instance(region, instance_id=None, filters=None):
+def get_instance(region, instance_id=None, filters=None, use_resource=False):
     '''
-    Return a InfraCtlInstance object
+    Return a InfraCtlInstance object. The same (region, instance_id) always resolves to the same shared
+    object; looking up an instance we already hold is free while its data is younger than cfg.instance_ttl.
     :param region: String region name
     :param instance_id: String AWS Instance ID
     :param filters: AWS boto3 filters
+    :param use_resource: Back the instance with a lazy boto3 ec2.Instance resource
     :return: InfraCtlInstance
     '''
     if not instance_id and filters:
-        client = boto3.client('ec2', region)
-        reservations = client.describe_instances(Filters=filters)
-        instances = [i for re in reservations['Reservations'] for i in re['Instances']]
+        client = get_client('ec2', region)
+        instances = list(iter_instance_data(client, filters=filters))
 
         if len(instances) > 1:
             raise InfraCtlInstanceException('Located {n} instances given filters: {f}'.format(n=len(instances), f=filters))
 
         try:
-            instance_id = instances[0].get('InstanceId')
+            data = instances[0]
+            instance_id = data['InstanceId']
         except (IndexError, KeyError):
             if sys.version_info.major < 3:
                 raise InfraCtlInstanceException('Unable to get the instance id given filters %s' % filters)
             else:
                 raise InfraCtlInstanceException('Unable to get the instance id given filters %s' % filters) from None
 
-    if instance_id:
-        ji = InfraInstance(region, instance_id)
+        ji = _hydrate(region, data, use_resource=use_resource)
         logger.debug('Loaded Instance: %s', ji)
         return ji
 
+    if instance_id:
+        key = (region, instance_id)
+        with _identity_lock:
+            ji = _identity_map.get(key)
+
+        if ji is None:
+            # describe_instances happens outside the lock so lookups of other instances don't queue behind it
+            loaded = InfraInstance(region, instance_id, use_resource=use_resource)
+            with _identity_lock:
+                ji = _identity_map.get(key)
+                if ji is None:
+                    _identity_map[key] = loaded
+                    logger.debug('Loaded Instance: %s', loaded)
+                    return loaded
+
+            # another thread got there first; keep its object, but ours has the newer data
+            ji.update(loaded.data)
+        else:
+            ji.reload()
+
+        if use_resource:
+            ji.attach_resource()
+        return ji
+
     return None
 
 
 # Meant to find any number of instances with the provided filters across the specified regions
-def get_instances(regions, filters):
+def get_instances(regions, filters, use_resource=False, concurrent=False, max_workers=None, timeout=None):
     '''
-    Return a list of InfraCtlInstance objects
-    :param regions: String region name
+    Return a list of InfraCtlInstance objects. Instances are built straight from the describe_instances
+    payload, so listing costs one call per page per region rather than one call per instance.
+
+    With concurrent=True the regions are queried in parallel (see get_instances_by_region). If any region
+    fails an InfraCtlRegionException is raised carrying both the instances that did come back (.results)
+    and the per-region errors (.failures).
+
+    :param regions: List of region names
     :param filters: AWS boto3 filters
+    :param use_resource: Back each instance with a lazy boto3 ec2.Instance resource
+    :param concurrent: Query the regions in parallel
+    :param max_workers: Max number of regions in flight at once (concurrent only). Defaults to all of them
+    :param timeout: Seconds allowed per region (concurrent only)
     :return: List of InfraCtlInstance Objects
     '''
+    if concurrent:
+        instances, failures = get_instances_by_region(regions, filters, use_resource=use_resource,
+                                                      max_workers=max_workers, timeout=timeout)
+        if failures:
+            raise InfraCtlRegionException('Unable to query region(s): {r}'.format(r=', '.join(sorted(failures))),
+                                          results=instances, failures=failures)
+        return instances
+
     instances = []
     for r in regions:
-        client = boto3.client('ec2', r)
-        reservations = client.describe_instances(Filters=filters)
-        _instances = [i for re in reservations['Reservations'] for i in re['Instances']]
-
-        if _instances:
-            for i in _instances:
-                instances.append(InfraInstance(r, i['InstanceId']))
+        client = get_client('ec2', r)
+        for i in iter_instance_data(client, filters=filters):
+            instances.append(_hydrate(r, i, use_resource=use_resource))
 
     return instances
 
 
+# Meant to query many regions at once, keeping whatever comes back even if some regions fail
+def get_instances_by_region(regions, filters, use_resource=False, max_workers=None, timeout=None):
+    '''
+    Query every region on a bounded pool (one in-flight describe per region) and merge the results as each
+    region completes. Wall time approaches the slowest region rather than the sum of all of them.
+    :param regions: List of region names
+    :param filters: AWS boto3 filters
+    :param use_resource: Back each instance with a lazy boto3 ec2.Instance resource
+    :param max_workers: Max number of regions in flight at once. Defaults to all of them
+    :param timeout: Seconds allowed per region before it is reported as failed
+    :return: Tuple of (list of InfraCtlInstance objects, dict of region -> error string)
+    '''
+    def query(region):
+        client = get_client('ec2', region)
+        return list(iter_instance_data(client, filters=filters))
+
+    instances = []
+    failures = {}
+    for region, data, error in fan_out(regions, query, max_workers=max_workers, timeout=timeout):
+        if error is not None:
+            logger.error('Unable to query instances in %s: %s', region, error)
+            failures[region] = str(error)
+            continue
+
+        logger.debug('%s returned %d instance(s)', region, len(data))
+        for i in data:
+            instances.append(_hydrate(region, i, use_resource=use_resource))
+
+    return instances, failures
+
+
+# Meant to wait on any number of instances with one describe call per region (per chunk of ids) per poll
+def iter_wait_for_state(instances, target_state='running', timeout=300, base_delay=2, max_delay=30):
+    '''
+    Poll a set of InfraInstances until they reach target_state, yielding each one as it arrives. Every poll is
+    a single batched describe_instances per region (chunked by INSTANCE_ID_CHUNK) and polls back off
+    exponentially with jitter. Iteration simply stops at the deadline; whatever hasn't been yielded by then
+    didn't make it. Instances are refreshed in place, so their state is current when they come out.
+    :param instances: iterable of InfraInstance
+    :param target_state: One of INSTANCE_LIFECYCLE_STATES
+    :param timeout: Overall deadline in seconds
+    :param base_delay: Delay before the second poll (the first poll is immediate)
+    :param max_delay: Upper bound on the delay between polls
+    :return: generator of InfraInstance
+    '''
+    if target_state not in INSTANCE_LIFECYCLE_STATES:
+        raise InfraCtlInstanceException('{ts} is not a valid target state: {states}'.format(
+            ts=target_state, states=INSTANCE_LIFECYCLE_STATES))
+
+    pending = dict(((i.region, i.instance_id), i) for i in instances)
+    expiration_time = time.time() + timeout
+    attempt = 0
+
+    while pending:
+        by_region = {}
+        for region, instance_id in pending:
+            by_region.setdefault(region, []).append(instance_id)
+
+        for region, instance_ids in by_region.items():
+            client = get_client('ec2', region)
+            for chunk in chunks(instance_ids, INSTANCE_ID_CHUNK):
+                try:
+                    data = list(iter_instance_data(client, instance_ids=chunk))
+                except Exception as e:
+                    # freshly launched ids can take a moment to show up in describe calls
+                    logger.warning('Unable to describe %d instance(s) in %s: %s', len(chunk), region, e)
+                    continue
+
+                for d in data:
+                    instance = pending.get((region, d['InstanceId']))
+                    if instance is None:
+                        continue
+
+                    instance.update(d)
+                    state = instance.state.get('Name')
+
+                    if state == target_state:
+                        del pending[(region, d['InstanceId'])]
+                        yield instance
+                    elif state == 'terminated':
+                        logger.warning('%s was terminated while waiting for %s', instance, target_state)
+                        del pending[(region, d['InstanceId'])]
+
+        if not pending:
+            return
+
+        delay = backoff_delay(attempt, base=base_delay, cap=max_delay)
+        if time.time() + delay > expiration_time:
+            logger.warning('Timed out waiting on %d instance(s) to reach %s', len(pending), target_state)
+            return
+
+        time.sleep(delay)
+        attempt += 1
+
+
+def wait_for_state(instances, target_state='running', timeout=300, base_delay=2, max_delay=30):
+    '''
+    Blocking form of iter_wait_for_state
+    :return: Tuple of (list of instances that reached target_state, list of those that didn't)
+    '''
+    instances = list(instances)
+    ready = list(iter_wait_for_state(instances, target_state, timeout, base_delay, max_delay))
+    ready_ids = set(id(i) for i in ready)
+
+    return ready, [i for i in instances if id(i) not in ready_ids]
+
+
+def _bulk_action(action, instances, **kwargs):
+    by_region = {}
+    for i in instances:
+        by_region.setdefault(i.region, []).append(i.instance_id)
+
+    for region, instance_ids in by_region.items():
+        client = get_client('ec2', region)
+        for chunk in chunks(instance_ids, INSTANCE_ID_CHUNK):
+            logger.info('%s %d instance(s) in %s', action, len(chunk), region)
+            getattr(client, action)(InstanceIds=chunk, **kwargs)
+
+
+def start_instances(instances, wait=True, timeout=300):
+    '''
+    Start any number of instances (one call per region per chunk of ids), optionally waiting for 'running'
+    :return: Tuple of (ready, not ready) instances if waiting, otherwise None
+    '''
+    instances = list(instances)
+    _bulk_action('start_instances', instances)
+
+    if wait:
+        return wait_for_state(instances, 'running', timeout=timeout)
+
+
+def stop_instances(instances, wait=True, timeout=300, force=False):
+    '''
+    Stop any number of instances (one call per region per chunk of ids), optionally waiting for 'stopped'
+    :return: Tuple of (ready, not ready) instances if waiting, otherwise None
+    '''
+    instances = list(instances)
+    _bulk_action('stop_instances', instances, Force=force)
+
+    if wait:
+        return wait_for_state(instances, 'stopped', timeout=timeout)
+
+
+def reboot_instances(instances, wait=True, timeout=300):
+    '''
+    Reboot any number of instances (one call per region per chunk of ids), optionally waiting for 'running'.
+    A reboot doesn't move an instance out of 'running' in EC2, so waiting only confirms it's still there.
+    :return: Tuple of (ready, not ready) instances if waiting, otherwise None
+    '''
+    instances = list(instances)
+    _bulk_action('reboot_instances', instances)
+
+    if wait:
+        return wait_for_state(instances, 'running', timeout=timeout)
+
+
+# Meant for holding very large inventories in memory. Yields InstanceRecords rather than InfraInstances
+def get_instance_records(regions, filters=None):
+    '''
+    Generate compact InstanceRecord objects across the specified regions
+    :param regions: List of region names
+    :param filters: AWS boto3 filters
+    :return: generator of InstanceRecord
+    '''
+    for r in regions:
+        client = get_client('ec2', r)
+        for i in iter_instance_data(client, filters=filters):
+            yield InstanceRecord.from_data(r, i)
+
+
+def _intern(val):
+    return sys.intern(val) if isinstance(val, str) else val
+
+
+class InstanceRecord(object):
+    '''
+    A lightweight, read-only stand in for InfraInstance. No payload dict, no boto3 objects, no per-instance
+    __dict__; region/state/tag strings are interned so a large inventory shares one copy of each.
+    Use to_instance() to get the full InfraInstance when one is actually needed.
+    '''
+    __slots__ = ('region', 'instance_id', 'name', 'state', 'private_ip_address', 'public_ip_address', 'tags')
+
+    def __init__(self, region, instance_id, name=None, state=None, private_ip_address=None,
+                 public_ip_address=None, tags=()):
+        self.region = _intern(region)
+        self.instance_id = instance_id
+        self.name = name
+        self.state = _intern(state)
+        self.private_ip_address = private_ip_address
+        self.public_ip_address = public_ip_address
+        self.tags = tuple((_intern(k), _intern(v)) for k, v in tags)
+
+    def __repr__(self):
+        return '<InstanceRecord: [{region}] {id}:{name}>'.format(
+            region=self.region, id=self.instance_id, name=self.name)
+
+    @classmethod
+    def from_data(cls, region, data):
+        tags = [(t['Key'], t['Value']) for t in data.get('Tags') or []]
+        name = None
+        for k, v in tags:
+            if k == 'Name':
+                name = v
+                break
+
+        return cls(region, data['InstanceId'],
+                   name=name,
+                   state=(data.get('State') or {}).get('Name'),
+                   private_ip_address=data.get('PrivateIpAddress'),
+                   public_ip_address=data.get('PublicIpAddress'),
+                   tags=tags)
+
+    @property
+    def hostname(self):
+        hostname = '{name}.{region}'.format(name=self.name, region=self.region)
+        if cfg.tld:
+            hostname = '{h}.{tld}'.format(h=hostname, tld=cfg.tld)
+
+        return hostname
+
+    def tag(self, key, default=None):
+        for k, v in self.tags:
+            if k == key:
+                return v
+
+        return default
+
+    def to_instance(self, use_resource=False):
+        '''
+        :return: The full (shared) InfraInstance for this record
+        '''
+        return get_instance(self.region, self.instance_id, use_resource=use_resource)
+
+
 class InfraInstance(object):
-    def __init__(self, region, instance_id):
+    '''
+    An EC2 instance. By default this is hydrated from the describe_instances payload (self.data) and never
+    touches the boto3 resource API. Pass use_resource=True to opt in to a lazily loaded boto3 ec2.Instance
+    (available as self.ec2Instance).
+
+    Prefer get_instance/get_instances over building these directly - they hand out one shared object per
+    (region, instance_id). reload() is a no-op while the data is younger than cfg.instance_ttl seconds;
+    use reload(force=True) to always go back to AWS.
+    '''
+    def __init__(self, region, instance_id, data=None, use_resource=False):
         self.region = region
         self.instance_id = instance_id
+        self.data = data
+        self.use_resource = use_resource
         self.ec2Instance = None
         self.name = None
         self.hostname = None
+        self.loaded_at = 0
 
-        self.__load()
+        self.__load(fetch=data is None)
 
     def __repr__(self):
         return '<InfraInstance: [{region}] {id}:{name}>'.format(
-            region=self.region, id=self.ec2Instance.instance_id, name=self.name)
-
-    def __load(self):
-        if self.ec2Instance is None:
-            ec2_res = boto3.resource('ec2', self.region)
-            self.ec2Instance = ec2_res.Instance(self.instance_id)
-        else:
-            self.ec2Instance.reload()
-
+            region=self.region, id=self.instance_id, name=self.name)
+
+    def __load(self, fetch=True):
+        if self.use_resource:
+            if self.ec2Instance is None:
+                ec2_res = get_resource('ec2', self.region)
+                self.ec2Instance = ec2_res.Instance(self.instance_id)
+                if self.data is not None:
+                    self.ec2Instance.meta.data = self.data
+                else:
+                    self.ec2Instance.load()
+            elif fetch:
+                self.ec2Instance.reload()
+
+            self.data = self.ec2Instance.meta.data
+        elif fetch:
+            client = get_client('ec2', self.region)
+            try:
+                self.data = next(iter_instance_data(client, instance_ids=[self.instance_id]))
+            except StopIteration:
+                raise InfraCtlInstanceException('Unable to locate instance {i} in {r}'.format(
+                    i=self.instance_id, r=self.region))
+
+        self.loaded_at = time.time()
         self.name = self.__getname()
         self.hostname = '{name}.{region}'.format(name=self.name, region=self.region)
 
         if cfg.tld:
             self.hostname = '{h}.{tld}'.format(h=self.hostname, tld=cfg.tld)
 
-        logger.info('Instance Loaded: %s', self)
+        logger.debug('Instance Loaded: %s', self)
 
     def __getname(self):
-        if not self.ec2Instance:
+        if not self.data:
             return 'UNKNOWN'
 
         try:
-            return [t['Value'] for t in self.ec2Instance.tags if t['Key'] == 'Name'][0]
+            return [t['Value'] for t in self.tags if t['Key'] == 'Name'][0]
         except IndexError:
             raise InfraCtlInstanceException('Unable to locate the instance Name in tags')
 
-    def reload(self):
-        self.__load()
+    @property
+    def tags(self):
+        return (self.data or {}).get('Tags') or []
 
-    def waitForState(self, target_state='running', timeout=300, sleep_time=5):
-        try:
-            _ = INSTANCE_LIFECYCLE_STATES[target_state]
-        except KeyError:
-            raise InfraCtlInstanceException('{ts} is not a valid target state: {states}'.format(ts=target_state, states=INSTANCE_LIFECYCLE_STATES))
+    @property
+    def state(self):
+        return (self.data or {}).get('State') or {}
 
-        expiration_time = time.time() + timeout
+    @property
+    def private_ip_address(self):
+        return (self.data or {}).get('PrivateIpAddress')
 
-        while self.ec2Instance.state['Name'] != target_state:
-            if time.time() > expiration_time:
-                return False
+    @property
+    def public_ip_address(self):
+        return (self.data or {}).get('PublicIpAddress')
 
-            time.sleep(sleep_time)
-            self.reload()
+    @property
+    def block_device_mappings(self):
+        return (self.data or {}).get('BlockDeviceMappings') or []
 
-        return True
+    @property
+    def root_device_name(self):
+        return (self.data or {}).get('RootDeviceName')
+
+    def is_fresh(self, ttl=None):
+        ttl = cfg.instance_ttl if ttl is None else ttl
+        return bool(ttl) and time.time() - self.loaded_at < ttl
+
+    def attach_resource(self):
+        '''
+        Opt an existing instance in to the boto3 ec2.Instance resource (self.ec2Instance), seeded with the data
+        we already have rather than loaded again
+        '''
+        if self.ec2Instance is None:
+            self.use_resource = True
+            self.ec2Instance = get_resource('ec2', self.region).Instance(self.instance_id)
+            if self.data is not None:
+                self.ec2Instance.meta.data = self.data
+
+        return self.ec2Instance
+
+    def update(self, data):
+        '''
+        Swap in a newer describe_instances payload for this instance without going back to AWS
+        '''
+        self.data = data
+        if self.ec2Instance is not None:
+            self.ec2Instance.meta.data = data
+
+        self.__load(fetch=False)
+
+    def reload(self, force=False):
+        if not force and self.is_fresh():
+            logger.debug('Skipping reload, data is fresh: %s', self)
+            return
+
+        self.__load()
+
+    def waitForState(self, target_state='running', timeout=300, sleep_time=5):
+        for _ in iter_wait_for_state([self], target_state, timeout=timeout, base_delay=sleep_time):
+            return True
+
+        return False
@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import threading
+import time
+import requests
+
+from .config import Config
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+cfg = Config()
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATH = '/latest/api/token'
+TOKEN_TTL_HEADER = 'X-aws-ec2-metadata-token-ttl-seconds'
+TOKEN_HEADER = 'X-aws-ec2-metadata-token'
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+
+
+def _boot_id():
+    # Ties the on-disk cache to this boot of this machine, so a cache baked into an AMI (or surviving a
+    # stop/start onto new hardware) is never trusted
+    try:
+        with open(BOOT_ID_FILE) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+class MetadataClient(object):
+    """
+    Talks to the EC2 instance metadata service. Uses IMDSv2 (falling back to v1 if no token can be had),
+    reuses the session token until it's about to expire, and memoizes the identity document in process and
+    optionally on disk so later CLI runs don't have to ask again.
+    """
+    def __init__(self, base_url=None, document_path=None, connect_timeout=None, read_timeout=None,
+                 token_ttl=None, cache_path=None, cache_ttl=None):
+        '''
+        :param cache_path: File to persist the identity document in. None uses cfg.instance_meta_cache; pass
+            False (or '') to keep it in memory only
+        '''
+        meta_url = urlparse(cfg.instance_meta_url)
+
+        self.base_url = (base_url or '{s}://{n}'.format(s=meta_url.scheme, n=meta_url.netloc)).rstrip('/')
+        self.document_path = document_path or meta_url.path
+        self.connect_timeout = connect_timeout if connect_timeout is not None else cfg.instance_meta_connect_timeout
+        self.read_timeout = read_timeout if read_timeout is not None else cfg.instance_meta_read_timeout
+        self.token_ttl = token_ttl or cfg.instance_meta_token_ttl
+        self.cache_path = cache_path if cache_path is not None else cfg.instance_meta_cache
+        self.cache_ttl = cache_ttl if cache_ttl is not None else cfg.instance_meta_cache_ttl
+
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._token = None
+        self._token_expires = 0
+        self._identity = None
+
+    def __repr__(self):
+        return '<MetadataClient: {url}>'.format(url=self.base_url)
+
+    def _timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def token(self, refresh=False):
+        '''
+        :return: A (possibly reused) IMDSv2 token, or None if the service won't give us one
+        '''
+        # refresh a minute early so a token never expires mid request
+        if not refresh and self._token and time.time() < self._token_expires - 60:
+            return self._token
+
+        try:
+            resp = self._session.put(self.base_url + TOKEN_PATH, headers={TOKEN_TTL_HEADER: str(self.token_ttl)},
+                                     timeout=self._timeout())
+        except requests.RequestException as e:
+            logger.debug('Unable to get an IMDSv2 token: %s', e)
+            return None
+
+        if resp.status_code != 200:
+            logger.debug('IMDSv2 token request returned %s, falling back to IMDSv1', resp.status_code)
+            return None
+
+        self._token = resp.text
+        self._token_expires = time.time() + self.token_ttl
+        return self._token
+
+    def get(self, path):
+        '''
+        GET a metadata path
+        :param path: String path, e.g. /latest/meta-data/instance-id
+        :return: String response body or None
+        '''
+        url = self.base_url + path
+
+        for attempt in (1, 2):
+            token = self.token(refresh=attempt > 1)
+            headers = {TOKEN_HEADER: token} if token else {}
+
+            try:
+                resp = self._session.get(url, headers=headers, timeout=self._timeout())
+            except requests.RequestException as e:
+                logger.error('Unable to query aws for metadata: %s', e)
+                return None
+
+            # a 401 means our token went stale underneath us - get a new one and try once more
+            if resp.status_code == 401 and attempt == 1:
+                continue
+
+            if resp.status_code != 200:
+                logger.error('Unable to query aws for metadata (%s): %s', resp.status_code, url)
+                return None
+
+            return resp.text
+
+        return None
+
+    def identity(self, refresh=False):
+        '''
+        :param refresh: Ignore the in-process and on-disk caches
+        :return: The instance identity document as a dict (region, instanceId, accountId, ...) or None
+        '''
+        with self._lock:
+            if self._identity is not None and not refresh:
+                return self._identity
+
+            if not refresh:
+                self._identity = self._read_cache()
+                if self._identity is not None:
+                    return self._identity
+
+            body = self.get(self.document_path)
+            if body is None:
+                return None
+
+            try:
+                self._identity = json.loads(body)
+            except ValueError:
+                logger.error('Unable to load the identity document as json')
+                logger.debug(body)
+                return None
+
+            self._write_cache(self._identity)
+            return self._identity
+
+    def region(self):
+        return (self.identity() or {}).get('region')
+
+    def instance_id(self):
+        return (self.identity() or {}).get('instanceId')
+
+    def account_id(self):
+        return (self.identity() or {}).get('accountId')
+
+    def _read_cache(self):
+        if not self.cache_path:
+            return None
+
+        path = os.path.expanduser(self.cache_path)
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if cached.get('boot_id') != _boot_id():
+            logger.debug('Ignoring identity cache from another boot: %s', path)
+            return None
+
+        if self.cache_ttl and time.time() - cached.get('fetched_at', 0) > self.cache_ttl:
+            logger.debug('Ignoring expired identity cache: %s', path)
+            return None
+
+        return cached.get('document')
+
+    def _write_cache(self, document):
+        if not self.cache_path:
+            return
+
+        path = os.path.expanduser(self.cache_path)
+        tmp = '{p}.{pid}'.format(p=path, pid=os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            with open(tmp, 'w') as f:
+                json.dump({'boot_id': _boot_id(), 'fetched_at': time.time(), 'document': document}, f)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logger.warning('Unable to write identity cache %s: %s', path, e)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    '''
+    :return: The shared MetadataClient for this process
+    '''
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = MetadataClient()
+
+    return _client
+
+
+def get_identity(refresh=False):
+    return get_client().identity(refresh=refresh)
+
+
+def get_region():
+    return get_client().region()
@@ -0,0 +1,177 @@
+import json
+import logging
+import threading
+import time
+
+from .config import Config
+
+cfg = Config()
+
+logger = logging.getLogger(__name__)
+
+
+def log_progress(snapshot):
+    '''
+    Default TransferProgress hook: one INFO line per report
+    '''
+    eta = snapshot['eta']
+    logger.info('%s: %d/%s files, %.1f/%s MB, %.2f MB/s, %.1f files/s, eta %s', snapshot['name'], snapshot['files'],
+                snapshot['total_files'] if snapshot['total_files'] is not None else '?', snapshot['bytes'] / 1e6,
+                '%.1f' % (snapshot['total_bytes'] / 1e6) if snapshot['total_bytes'] is not None else '?',
+                snapshot['bytes_per_sec'] / 1e6, snapshot['files_per_sec'],
+                '%ds' % eta if eta is not None else '?')
+
+
+class TransferProgress(object):
+    """
+    Thread safe running totals for any number of transfers (files, channels and hosts), reported at most
+    once per interval instead of on every write. The transfer methods on InfraCtlSFTPClient take one of
+    these as progress=; share a single instance across hosts to get fleet wide numbers.
+
+        progress = TransferProgress('release 1.2.3')
+        for sftp in clients:
+            sftp.upload(source, target, progress=progress)
+        progress.finish()
+        progress.write_summary('/var/log/deploys/1.2.3.json')
+
+    hook is called with a snapshot dict (see snapshot()) on every report, in whichever thread triggered it.
+    """
+    def __init__(self, name='transfer', interval=None, hook=log_progress):
+        '''
+        :param interval: Seconds between reports (cfg.progress_interval). 0 reports on every update
+        :param hook: Callable taking a snapshot dict, or None to only keep totals
+        '''
+        self.name = name
+        self.interval = interval if interval is not None else cfg.progress_interval
+        self.hook = hook
+
+        self.started = time.time()
+        self.finished = None
+        self.total_bytes = None
+        self.total_files = None
+        self.bytes = 0
+        self.files = 0
+        self.failed = 0
+        self.hosts = {}
+
+        self._lock = threading.Lock()
+        self._last_report = 0
+
+    def __repr__(self):
+        return '<TransferProgress: {n}, {f} files, {b} bytes>'.format(n=self.name, f=self.files, b=self.bytes)
+
+    def _host(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = {'bytes': 0, 'files': 0, 'failed': 0, 'started': time.time()}
+        return self.hosts[host]
+
+    def add_total(self, nbytes, nfiles, host=None):
+        '''
+        Announces work that's about to start, so rates come with an ETA
+        '''
+        with self._lock:
+            self.total_bytes = (self.total_bytes or 0) + nbytes
+            self.total_files = (self.total_files or 0) + nfiles
+            self._host(host)
+
+    def update(self, nbytes, host=None):
+        with self._lock:
+            self.bytes += nbytes
+            self._host(host)['bytes'] += nbytes
+
+        self.report()
+
+    def rollback(self, nbytes, host=None):
+        '''
+        Take back bytes counted by update() for a transfer that then failed, so totals only reflect data that
+        actually made it
+        '''
+        with self._lock:
+            self.bytes -= nbytes
+            self._host(host)['bytes'] -= nbytes
+
+    def file_done(self, host=None, failed=False):
+        with self._lock:
+            stats = self._host(host)
+            if failed:
+                self.failed += 1
+                stats['failed'] += 1
+            else:
+                self.files += 1
+                stats['files'] += 1
+
+        self.report()
+
+    def snapshot(self):
+        '''
+        :return: {'name', 'bytes', 'files', 'failed', 'total_bytes', 'total_files', 'elapsed', 'bytes_per_sec',
+            'files_per_sec', 'eta', 'hosts': {host: {'bytes', 'files', 'failed', 'bytes_per_sec'}}}
+        '''
+        with self._lock:
+            now = self.finished or time.time()
+            elapsed = max(now - self.started, 1e-6)
+            bytes_per_sec = self.bytes / elapsed
+
+            eta = None
+            if self.finished:
+                eta = 0
+            elif self.total_bytes is not None and bytes_per_sec > 0:
+                eta = max(self.total_bytes - self.bytes, 0) / bytes_per_sec
+
+            hosts = {}
+            for host, stats in self.hosts.items():
+                hosts[str(host)] = {
+                    'bytes': stats['bytes'],
+                    'files': stats['files'],
+                    'failed': stats['failed'],
+                    'bytes_per_sec': stats['bytes'] / max(now - stats['started'], 1e-6),
+                }
+
+            return {
+                'name': self.name,
+                'bytes': self.bytes,
+                'files': self.files,
+                'failed': self.failed,
+                'total_bytes': self.total_bytes,
+                'total_files': self.total_files,
+                'elapsed': elapsed,
+                'bytes_per_sec': bytes_per_sec,
+                'files_per_sec': self.files / elapsed,
+                'eta': eta,
+                'hosts': hosts,
+            }
+
+    def report(self, force=False):
+        '''
+        Calls the hook if interval has passed since the last report (or force)
+        '''
+        if self.hook is None:
+            return
+
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_report < self.interval:
+                return
+            self._last_report = now
+
+        try:
+            self.hook(self.snapshot())
+        except Exception as e:
+            logger.warning('Progress hook failed: %s', e)
+
+    def finish(self):
+        '''
+        Stops the clock and sends a final report
+        :return: The final snapshot
+        '''
+        self.finished = time.time()
+        self.report(force=True)
+
+        return self.snapshot()
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def write_summary(self, path):
+        with open(path, 'w') as fh:
+            fh.write(self.to_json())
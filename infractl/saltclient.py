@@ -0,0 +1,479 @@
+import abc
+import json
+import logging
+import subprocess
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .exception import InfraCtlSaltException
+from .config import Config
+
+cfg = Config()
+
+logger = logging.getLogger(__name__)
+
+# How each tgt_type is spelled on the salt command line
+TGT_FLAGS = {
+    'glob': '',
+    'compound': '-C',
+    'list': '-L',
+    'grain': '-G',
+}
+
+
+# abc.ABC spelled so it works on python 2.7 as well
+_ABC = abc.ABCMeta('_ABC', (object,), {})
+
+
+class SaltTransport(_ABC):
+    """
+    How sodium actually talks to salt. Every backend takes a ready made target (a compound string, glob,
+    or list of minion ids) plus its tgt_type and exposes:
+
+        cmd(target, fun, args, tgt_type, timeout)       -> {minion_id: return}
+        cmd_iter(target, fun, args, tgt_type, timeout)  -> iterator of (minion_id, return) as they land
+
+    cmd_iter returns a ReturnIter; once it is exhausted its .missing lists the minions that were expected
+    (or that salt reported) but never returned.
+
+    For fire-and-collect use there is also:
+
+        submit(target, fun, args, tgt_type, timeout)    -> job handle (returns immediately)
+        ready(job)                                      -> True once the job has finished
+        result(job)                                     -> {minion_id: return}
+
+    By default a job is just cmd() running on its own thread; backends with a native async API override.
+    cmd and cmd_iter are abstract, a backend missing either can't be instantiated.
+    """
+    name = None
+
+    def __repr__(self):
+        return '<{cls}>'.format(cls=self.__class__.__name__)
+
+    @abc.abstractmethod
+    def cmd(self, target, fun, args=(), tgt_type='glob', timeout=None, opts=None):
+        pass
+
+    @abc.abstractmethod
+    def cmd_iter(self, target, fun, args=(), tgt_type='glob', timeout=None, expected=None):
+        pass
+
+    def submit(self, target, fun, args=(), tgt_type='glob', timeout=None):
+        return _ThreadJob(self.cmd, target, fun, args, tgt_type, timeout)
+
+    def ready(self, job):
+        return job.done.is_set()
+
+    def result(self, job):
+        if job.error is not None:
+            raise job.error
+
+        return job.ret
+
+
+class _ThreadJob(object):
+    def __init__(self, func, *args):
+        self.jid = None
+        self.ret = None
+        self.error = None
+        self.done = threading.Event()
+
+        t = threading.Thread(target=self._run, args=(func,) + args)
+        t.daemon = True
+        t.start()
+
+    def _run(self, func, *args):
+        try:
+            self.ret = func(*args)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+class _LocalJob(object):
+    def __init__(self, jid, minions, timeout):
+        self.jid = jid
+        self.minions = set(minions or [])
+        self.deadline = time.time() + timeout if timeout else None
+        self.ret = {}
+
+
+def _expected(target, tgt_type, expected):
+    if expected is None and tgt_type == 'list':
+        expected = target.split(',') if isinstance(target, str) else target
+
+    return expected
+
+
+class SubprocessTransport(SaltTransport):
+    """
+    Shells out to the salt CLI for every call. Slow to start (salt's imports and auth every time) but has no
+    requirements beyond the salt binary being on the PATH.
+    """
+    name = 'subprocess'
+
+    def build_cmd(self, target, fun, args=(), tgt_type='glob', opts='--out=json --static'):
+        try:
+            flag = TGT_FLAGS[tgt_type]
+        except KeyError:
+            raise InfraCtlSaltException('tgt_type: {t} not supported'.format(t=tgt_type))
+
+        if not isinstance(target, str):
+            target = ','.join(target)
+
+        return "salt {flag}'{target}' {fun} {args} {opts}".format(
+            flag=flag + ' ' if flag else '',
+            target=target,
+            fun=fun,
+            args=' '.join(args),
+            opts=opts
+        )
+
+    def cmd(self, target, fun, args=(), tgt_type='glob', timeout=None, opts=None):
+        opts = opts or '--out=json --static'
+        if timeout:
+            opts = '{o} --timeout={t}'.format(o=opts, t=int(timeout))
+
+        cmd = self.build_cmd(target, fun, args, tgt_type, opts)
+
+        logger.debug('salt cmd: %s', cmd)
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # communicate() drains both pipes while waiting, so a large return can't wedge us on a full pipe buffer
+        stdout, _ = proc.communicate()
+
+        # Keep in mind that running most salt commands can and will yield a 0 exit status even though the command ran
+        # actually failed or bombed in some way - in which it yielded something other than a 0 exit code. This is
+        # because salt considers the transportation of the command and results (via salt) to be successful. You can get a
+        # non-zero exit code from salt when the salt command itself failed in some way.
+        try:
+            return json.loads(stdout.decode('utf-8', 'replace'))
+        except ValueError:
+            return {}
+
+    def cmd_iter(self, target, fun, args=(), tgt_type='glob', timeout=None, expected=None):
+        opts = '--out=json --out-indent=-1'
+        if timeout:
+            opts = '{o} --timeout={t}'.format(o=opts, t=int(timeout))
+
+        return SaltStream(self.build_cmd(target, fun, args, tgt_type, opts), timeout=timeout,
+                          expected=_expected(target, tgt_type, expected))
+
+
+class LocalClientTransport(SaltTransport):
+    """
+    In-process salt.client.LocalClient (salt-master only), created once and reused for every call so we
+    pay salt's import and auth cost a single time. LocalClient isn't safe to share between threads, so
+    calls are serialized on a lock (cmd_iter only holds it while creating the iterator, not while it is read).
+    """
+    name = 'local'
+
+    def __init__(self, client=None):
+        self._client = client
+        self._lock = threading.RLock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import salt.client
+                self._client = salt.client.LocalClient()
+
+        return self._client
+
+    def cmd(self, target, fun, args=(), tgt_type='glob', timeout=None, opts=None):
+        kwargs = {'tgt_type': tgt_type}
+        if timeout:
+            kwargs['timeout'] = timeout
+
+        with self._lock:
+            return self.client.cmd(target, fun, list(args), **kwargs) or {}
+
+    def cmd_iter(self, target, fun, args=(), tgt_type='glob', timeout=None, expected=None):
+        kwargs = {'tgt_type': tgt_type}
+        if timeout:
+            kwargs['timeout'] = timeout
+
+        # only the setup is serialized: holding the lock across the yields would stall every other call on
+        # this transport for as long as the caller takes to consume (or abandon) the iterator
+        with self._lock:
+            events = self.client.cmd_iter(target, fun, list(args), **kwargs)
+
+        def returns():
+            for event in events:
+                for minion_id, ret in (event or {}).items():
+                    yield minion_id, ret.get('ret') if isinstance(ret, dict) else ret
+
+        return ReturnIter(returns(), expected=_expected(target, tgt_type, expected))
+
+    def submit(self, target, fun, args=(), tgt_type='glob', timeout=None):
+        # run_job publishes and returns right away with the jid and the minions expected to answer
+        timeout = timeout or cfg.salt_job_timeout
+        with self._lock:
+            pub = self.client.run_job(target, fun, list(args), tgt_type=tgt_type, timeout=timeout)
+
+        if not pub or not pub.get('jid'):
+            raise InfraCtlSaltException('Unable to publish {f} to {t}'.format(f=fun, t=target))
+
+        return _LocalJob(pub['jid'], pub.get('minions'), timeout)
+
+    def ready(self, job):
+        # the publish matched nobody, so nobody is going to answer
+        if not job.minions:
+            return True
+
+        with self._lock:
+            returns = self.client.get_cache_returns(job.jid) or {}
+
+        job.ret = dict((m, r.get('ret') if isinstance(r, dict) else r) for m, r in returns.items())
+
+        if job.minions and job.minions.issubset(job.ret):
+            return True
+
+        return job.deadline is not None and time.time() > job.deadline
+
+    def result(self, job):
+        return job.ret
+
+
+class CallerTransport(SaltTransport):
+    """
+    In-process salt.client.Caller (minions), created once and reused. Targets other minions through
+    publish.publish, which has no streaming form, so cmd_iter yields from a single blocking call.
+    """
+    name = 'caller'
+
+    def __init__(self, caller=None):
+        self._caller = caller
+        self._lock = threading.RLock()
+
+    @property
+    def caller(self):
+        with self._lock:
+            if self._caller is None:
+                import salt.client
+                self._caller = salt.client.Caller()
+
+        return self._caller
+
+    def cmd(self, target, fun, args=(), tgt_type='glob', timeout=None, opts=None):
+        # publish.publish wants a single arg string (comma separated) rather than a list
+        arg = ','.join(args) if not isinstance(args, str) else args
+        if not isinstance(target, str):
+            target = ','.join(target)
+
+        # publish.publish(tgt, fun, arg, tgt_type, returner, timeout, ...) - timeout has to go by keyword
+        pub_kwargs = {}
+        if timeout:
+            pub_kwargs['timeout'] = int(timeout)
+
+        with self._lock:
+            return self.caller.function('publish.publish', target, fun, arg, tgt_type, **pub_kwargs) or {}
+
+    def cmd_iter(self, target, fun, args=(), tgt_type='glob', timeout=None, expected=None):
+        def returns():
+            for minion_id, ret in self.cmd(target, fun, args, tgt_type, timeout).items():
+                yield minion_id, ret
+
+        return ReturnIter(returns(), expected=_expected(target, tgt_type, expected))
+
+
+class ReturnIter(object):
+    """
+    Iterates (minion_id, return) pairs and keeps track of who answered. Once iteration finishes: returned
+    holds the minions that answered, missing the ones that didn't (anything in expected that never showed
+    up, plus whatever the backend reported as not returning), timed_out whether the call ran out of time,
+    and stderr whatever salt complained about.
+    """
+    def __init__(self, returns=None, expected=None):
+        self._returns = returns
+        self.expected = set(expected or [])
+
+        self.returned = set()
+        self.missing = []
+        self.stderr = ''
+        self.timed_out = False
+        self.returncode = None
+
+    def __iter__(self):
+        try:
+            for minion_id, ret in self._returns:
+                self.returned.add(minion_id)
+                yield minion_id, ret
+        finally:
+            self._finish()
+
+    def _finish(self, no_return=()):
+        self.missing = sorted((set(no_return) | self.expected) - self.returned)
+
+        if self.missing:
+            logger.warning('%d minion(s) did not return: %s', len(self.missing), ', '.join(self.missing))
+
+    def summary(self):
+        return {
+            'returned': len(self.returned),
+            'missing': self.missing,
+            'timed_out': self.timed_out,
+            'returncode': self.returncode,
+            'stderr': self.stderr,
+        }
+
+
+class SaltStream(ReturnIter):
+    """
+    Runs a salt command and yields (minion_id, result) as each minion's return lands, instead of waiting on
+    the slowest minion and parsing one big blob. stdout and stderr are drained on their own threads so the
+    salt process can never block on a full pipe. Salt's "did not return" entries count as missing.
+    """
+    NO_RETURN = 'Minion did not return'
+
+    def __init__(self, cmd, timeout=None, expected=None):
+        '''
+        :param cmd: The salt command line. Must use --out=json without --static
+        :param timeout: Seconds for the whole call (also hand salt a matching --timeout in cmd). salt is
+            killed if it hasn't finished a few seconds past that
+        :param expected: Optional list of minion ids we expect to hear from
+        '''
+        super(SaltStream, self).__init__(expected=expected)
+
+        self.cmd = cmd
+        self.timeout = timeout
+
+    def __repr__(self):
+        return '<SaltStream: {cmd}>'.format(cmd=self.cmd)
+
+    def __iter__(self):
+        logger.debug('salt cmd: %s', self.cmd)
+        # exec so that killing proc on timeout kills salt itself rather than just the shell around it
+        proc = subprocess.Popen('exec ' + self.cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        lines = queue.Queue()
+        errors = []
+
+        def drain_stdout():
+            for line in iter(proc.stdout.readline, b''):
+                lines.put(line)
+            lines.put(None)
+
+        def drain_stderr():
+            for line in iter(proc.stderr.readline, b''):
+                errors.append(line)
+
+        threads = [threading.Thread(target=drain_stdout), threading.Thread(target=drain_stderr)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        # give salt a little slack past its own --timeout to report the stragglers before we kill it
+        deadline = time.time() + self.timeout + 5 if self.timeout else None
+        decoder = json.JSONDecoder()
+        buf = ''
+        no_return = set()
+
+        try:
+            while True:
+                try:
+                    wait = max(0, deadline - time.time()) if deadline else None
+                    line = lines.get(timeout=wait)
+                except queue.Empty:
+                    logger.error('salt did not finish within %s seconds, killing it: %s', self.timeout, self.cmd)
+                    self.timed_out = True
+                    proc.kill()
+                    break
+
+                if line is None:
+                    break
+
+                # one json document per line with --out-indent=-1, but don't rely on it
+                buf += line.decode('utf-8', 'replace')
+                while buf.strip():
+                    try:
+                        event, end = decoder.raw_decode(buf.lstrip())
+                    except ValueError:
+                        break
+                    buf = buf.lstrip()[end:]
+
+                    if not isinstance(event, dict):
+                        continue
+
+                    for minion_id, result in event.items():
+                        if isinstance(result, str) and result.startswith(self.NO_RETURN):
+                            no_return.add(minion_id)
+                            continue
+
+                        self.returned.add(minion_id)
+                        yield minion_id, result
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            self.returncode = proc.wait()
+
+            for t in threads:
+                t.join(1)
+
+            self.stderr = b''.join(errors).decode('utf-8', 'replace')
+            self._finish(no_return)
+
+
+BACKENDS = {
+    SubprocessTransport.name: SubprocessTransport,
+    LocalClientTransport.name: LocalClientTransport,
+    CallerTransport.name: CallerTransport,
+}
+
+_transports = {}
+_default = None
+_transports_lock = threading.Lock()
+
+
+def get_transport(name=None):
+    '''
+    Return the shared transport for a backend. Each backend is built once per process and reused.
+    :param name: 'subprocess', 'local', 'caller' or 'auto'. Defaults to whatever set_transport was handed,
+        falling back to cfg.salt_transport. 'auto' uses the in-process LocalClient when it can be created
+        (i.e. on a salt-master) and the CLI otherwise
+    :return: SaltTransport
+    '''
+    with _transports_lock:
+        if name is None and _default is not None:
+            return _default
+
+        name = name or cfg.salt_transport
+
+        if name == 'auto':
+            if 'auto' not in _transports:
+                try:
+                    local = LocalClientTransport()
+                    local.client
+                    _transports['auto'] = local
+                except Exception as e:
+                    logger.debug('LocalClient unavailable (%s), using the salt CLI', e)
+                    _transports['auto'] = SubprocessTransport()
+            return _transports['auto']
+
+        if name not in BACKENDS:
+            raise InfraCtlSaltException('Unknown salt transport {n}, choose from: {b}'.format(
+                n=name, b=', '.join(sorted(BACKENDS))))
+
+        if name not in _transports:
+            _transports[name] = BACKENDS[name]()
+
+        return _transports[name]
+
+
+def set_transport(transport):
+    '''
+    Make transport (a SaltTransport instance, a backend name, or None to go back to the configured default)
+    the one sodium uses by default
+    '''
+    global _default
+    if isinstance(transport, str):
+        transport = get_transport(transport)
+
+    with _transports_lock:
+        _default = transport
@@ -1,17 +1,27 @@
 
 import logging
 import json
-import subprocess
+import time
 import psutil
-import salt.client
 
-from .exception import InfraCtlSaltException
+from .exception import InfraCtlSaltException, InfraCtlTimeoutException
+from .cache import TTLCache
+from .saltclient import get_transport, SaltStream
 from .config import Config
 
 cfg = Config()
 
 logger = logging.getLogger(__name__)
 
+# Interfaces that carry a minion's private address, in order of preference
+PRIVATE_INTERFACES = ('eth0', 'ens3', 'ens5')
+
+# Only read-only functions are ever memoized - caching cmd.run or state.apply would turn repeats into no-ops
+CACHEABLE_PREFIXES = ('grains.', 'network.', 'pillar.get', 'pillar.item', 'mine.get')
+
+# Memoizes salt_call results keyed by (expr_form, target, method, args)
+cache = TTLCache(ttl=cfg.salt_cache_ttl, maxsize=cfg.salt_cache_size, path=cfg.salt_cache_path)
+
 
 def is_salt_master(proc_name='salt-master'):
     '''
@@ -41,44 +51,227 @@ def is_salt_master(proc_name='salt-master'):
     return False
 
 
-def salt_call(target, method, args=[], expr_form='grain', opts='--out=json --static'):
+def _cache_key(target, method, args, expr_form):
+    if isinstance(target, dict):
+        target = sorted((k, sorted(v) if isinstance(v, list) else v) for k, v in target.items())
+    elif not isinstance(target, str):
+        target = sorted(target)
+
+    return json.dumps([expr_form, target, method, list(args)])
+
+
+def _key_targets(key, minion_id):
+    expr_form, target = json.loads(key)[:2]
+    if expr_form == 'glob':
+        return target == minion_id
+    if expr_form == 'list':
+        return minion_id in (target.split(',') if isinstance(target, str) else target)
+
+    return False
+
+
+def invalidate_minion(minion_id):
+    '''
+    Drop every cached salt_call result that targeted, or contains a return from, this minion
+    :return: Number of entries dropped
+    '''
+    return cache.invalidate(predicate=lambda k, v: _key_targets(k, minion_id) or
+                            (isinstance(v, dict) and minion_id in v))
+
+
+def cache_stats():
+    stats = dict(cache.stats)
+    stats['size'] = len(cache)
+    return stats
+
+
+def salt_call(target, method, args=[], expr_form='grain', opts='--out=json --static', use_cache=True):
     '''
     OK for those reading... I spent like 30 minutes or so trying to get salt's LocalClient working with no luck.
     This implementation took 5 minutes, and it's rather solid. Modify as necessary (because we'll need to eventually)
+
+    ...and eventually came: how we reach salt is now up to saltclient.get_transport() (cfg.salt_transport),
+    the CLI being the default and LocalClient the in-process option. opts only apply to the CLI.
+
+    Results of read-only functions (CACHEABLE_PREFIXES) are memoized for cfg.salt_cache_ttl seconds, as long
+    as every minion answered (see invalidate_minion / cache_stats). Anything else always goes to the master.
     :param target:
     :param method:
     :param args:
     :param exp_form:
     :param opts:
+    :param use_cache: Set to False to always go to the master (a fresh, cacheable result is still cached)
     :return:
     '''
+    cacheable = cfg.salt_cache_ttl and method.startswith(CACHEABLE_PREFIXES)
+    key = _cache_key(target, method, args, expr_form)
+    if use_cache and cacheable:
+        res = cache.get(key)
+        if res is not None:
+            logger.debug('salt cache hit: %s', key)
+            return res
+
+    list_target = target
+    target, tgt_type = _target(target, expr_form)
+    res = get_transport().cmd(target, method, args, tgt_type, opts=opts)
+
+    if res and cacheable and _complete(res, list_target if expr_form == 'list' else None):
+        cache.set(key, res)
+
+    return res
+
+
+def _complete(res, expected=None):
+    '''
+    Whether every minion actually answered: no "Minion did not return" entries and, for list targets, nobody
+    left out. A partial result must not be cached or the missing minions stay missing for the whole ttl.
+    '''
+    if not isinstance(res, dict):
+        return True
+
+    for ret in res.values():
+        if isinstance(ret, str) and ret.startswith(SaltStream.NO_RETURN):
+            return False
+
+    if expected:
+        expected = expected.split(',') if isinstance(expected, str) else expected
+        if set(expected) - set(res):
+            return False
+
+    return True
+
+
+def _target(target, expr_form):
+    '''
+    Translate sodium's (target, expr_form) into the (target, tgt_type) salt itself understands
+    '''
     if expr_form == 'grain':
-        grains = ' and '.join(dict_to_grain_list(target))
-        cmd_base = "salt -C '{grains}'".format(grains=grains)
-    elif expr_form == 'glob':
-        cmd_base = "salt '{target}'".format(target=target)
-    else:
-        raise InfraCtlSaltException('expr_form: {e} not supported'.format(e=expr_form))
-
-    cmd = "{base} {method} {args} {opts}".format(
-        base=cmd_base,
-        method=method,
-        args=' '.join(args),
-        opts=opts
-    )
-
-    logger.debug('salt cmd: %s', cmd)
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    proc.wait()
-
-    # Keep in mind that running most salt commands can and will yield a 0 exit status even though the command ran
-    # actually failed or bombed in some way - in which it yielded something other than a 0 exit code. This is
-    # because salt considers the transportation of the command and results (via salt) to be successful. You can get a
-    # non-zero exit code from salt when the salt command itself failed in some way.
-    try:
-        return json.load(proc.stdout)
-    except ValueError:
-        return json.loads('{}')
+        return ' and '.join(dict_to_grain_list(target)), 'compound'
+    elif expr_form in ('glob', 'list'):
+        return target, expr_form
+
+    raise InfraCtlSaltException('expr_form: {e} not supported'.format(e=expr_form))
+
+
+def salt_call_iter(target, method, args=[], expr_form='grain', timeout=None, expected=None):
+    '''
+    Streaming salt_call: yields (minion_id, result) as each minion returns. See saltclient.ReturnIter for
+    what's available (missing minions, timeouts, ...) once it's exhausted.
+    :param timeout: Seconds for the whole call
+    :param expected: Optional list of minion ids we expect to hear from. Defaults to the target for
+        list targeting
+    :return: saltclient.ReturnIter
+    '''
+    target, tgt_type = _target(target, expr_form)
+    return get_transport().cmd_iter(target, method, args, tgt_type, timeout=timeout, expected=expected)
+
+
+class SaltJobs(object):
+    """
+    Fire-and-collect salt jobs. submit() queues a job and returns its job id straight away; up to
+    max_in_flight jobs run at once and as_completed() hands back (job_id, result) as each one finishes, so
+    several independent queries cost roughly the slowest of them rather than the sum.
+
+        jobs = SaltJobs()
+        ips = jobs.submit(grains, 'network.ip_addrs', ['eth0'])
+        roles = jobs.submit(minion_ids, 'grains.item', ['role'], 'list')
+        results = jobs.gather()
+
+    Results are the same {minion_id: return} dicts salt_call gives back. A job that errors or outlives
+    its timeout yields None and its error is kept in self.errors.
+    """
+    def __init__(self, max_in_flight=8, timeout=None, transport=None, poll_interval=0.2):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout or cfg.salt_job_timeout
+        self.transport = transport
+        self.poll_interval = poll_interval
+
+        self.queued = []
+        self.running = {}
+        self.results = {}
+        self.errors = {}
+        self._finished = []
+        self._counter = 0
+
+    def __repr__(self):
+        return '<SaltJobs: {q} queued, {r} running, {d} done>'.format(
+            q=len(self.queued), r=len(self.running), d=len(self.results))
+
+    def submit(self, target, method, args=[], expr_form='grain'):
+        '''
+        Queue a job. It starts as soon as there's a free slot
+        :return: String job id
+        '''
+        self._counter += 1
+        job_id = 'job-{n}'.format(n=self._counter)
+
+        target, tgt_type = _target(target, expr_form)
+        self.queued.append((job_id, target, method, list(args), tgt_type))
+        self._start()
+
+        return job_id
+
+    def _start(self):
+        transport = self.transport or get_transport()
+
+        while self.queued and len(self.running) < self.max_in_flight:
+            job_id, target, method, args, tgt_type = self.queued.pop(0)
+            try:
+                job = transport.submit(target, method, args, tgt_type, timeout=self.timeout)
+            except Exception as e:
+                logger.error('Unable to submit %s (%s %s): %s', job_id, method, target, e)
+                self.errors[job_id] = e
+                self.results[job_id] = None
+                self._finished.append(job_id)
+                continue
+
+            logger.debug('Submitted %s (jid %s): %s %s', job_id, job.jid, method, target)
+            self.running[job_id] = (job, time.time())
+
+    def as_completed(self):
+        '''
+        :return: generator of (job_id, result) in the order jobs finish
+        '''
+        transport = self.transport or get_transport()
+
+        while self.running or self.queued or self._finished:
+            for job_id, (job, started) in list(self.running.items()):
+                if transport.ready(job):
+                    try:
+                        self.results[job_id] = transport.result(job)
+                    except Exception as e:
+                        logger.error('%s failed: %s', job_id, e)
+                        self.errors[job_id] = e
+                        self.results[job_id] = None
+                elif time.time() - started > self.timeout + 5:
+                    self.errors[job_id] = InfraCtlTimeoutException('{j} did not finish within {t} seconds'.format(
+                        j=job_id, t=self.timeout))
+                    self.results[job_id] = None
+                else:
+                    continue
+
+                del self.running[job_id]
+                self._finished.append(job_id)
+
+            self._start()
+
+            if not self._finished:
+                time.sleep(self.poll_interval)
+                continue
+
+            while self._finished:
+                job_id = self._finished.pop(0)
+                yield job_id, self.results[job_id]
+
+    def gather(self):
+        '''
+        Wait for everything submitted so far
+        :return: dict of job_id -> result
+        '''
+        for _ in self.as_completed():
+            pass
+
+        return dict(self.results)
 
 
 def find_minions(target, method='network.ip_addrs', args='eth0', expr_form='compound'):
@@ -92,50 +285,128 @@ def find_minions(target, method='network.ip_addrs', args='eth0', expr_form='comp
         if expr_form == 'compound':
             target = ' and '.join(dict_to_grain_list(target))
 
-        caller = salt.client.Caller()
-        instances = caller.function('publish.publish', target, method, args, expr_form)
+        instances = get_transport('caller').cmd(target, method, [args], expr_form)
 
     return instances
 
 
 def dict_to_grain_list(grains):
+    '''
+    One compound expression per grain, meant to be joined with ' and '. Several values for the same grain
+    are OR'd together, so {'role': ['web', 'api']} matches minions with either role.
+    '''
     grain_list = []
     for g, v in grains.items():
         if isinstance(v, list):
-            for val in v:
-                grain_list.append('G@{grain}:{val}'.format(grain=g, val=val))
+            vals = ['G@{grain}:{val}'.format(grain=g, val=val) for val in v]
+            if len(vals) == 1:
+                grain_list.append(vals[0])
+            elif vals:
+                grain_list.append('( {expr} )'.format(expr=' or '.join(vals)))
         else:
             grain_list.append('G@{grain}:{val}'.format(grain=g, val=v))
 
     return grain_list
 
 
+def _minion_return(res, minion_id, method):
+    '''
+    Pull one minion's return out of a salt_call result, or None if it didn't return anything usable.
+    Returns may or may not come wrapped in a {method: ...} dict depending on how salt was invoked.
+    '''
+    try:
+        ret = res[minion_id]
+    except (KeyError, TypeError):
+        return None
+
+    if isinstance(ret, dict) and method in ret:
+        ret = ret[method]
+
+    return ret
+
+
+def get_grains(minion_ids, grains):
+    '''
+    Fetch any number of grains for any number of minions with a single grains.item call (list targeting).
+    :param minion_ids: List of minion ids (a single string is fine too)
+    :param grains: List of grain names
+    :return: dict of minion_id -> {grain: value}. Minions that didn't return are present with a value of None
+    '''
+    if isinstance(minion_ids, str):
+        minion_ids = [minion_ids]
+
+    minion_ids = list(minion_ids)
+    if not minion_ids:
+        return {}
+
+    method = 'grains.item'
+    res = salt_call(minion_ids, method, list(grains), 'list')
+
+    values = {}
+    for minion_id in minion_ids:
+        ret = _minion_return(res, minion_id, method)
+
+        # non-responders come back as a "Minion did not return" string, or not at all
+        if not isinstance(ret, dict):
+            logger.warning('No grains returned for %s', minion_id)
+            values[minion_id] = None
+            continue
+
+        values[minion_id] = dict((g, ret.get(g)) for g in grains)
+
+    return values
+
+
 def get_grain_val(minion_id, grain):
-    method = 'grains.get'
-    res = salt_call(minion_id, method, [grain], 'glob')
+    res = get_grains([minion_id], [grain])
 
-    try:
-        return res[minion_id][method]
-    except KeyError:
+    if res.get(minion_id) is None:
         raise InfraCtlSaltException('Unable to pull grain {g} for {m}'.format(g=grain, m=minion_id))
 
+    return res[minion_id][grain]
 
-def get_private_ip(minion_id):
-    i_faces = ['eth0', 'ens3']
-    method = 'network.ip_addrs'
-    ip = None
 
+def get_interfaces(minion_ids):
+    '''
+    Fetch the network interfaces of any number of minions with a single network.interfaces call
+    :param minion_ids: List of minion ids (a single string is fine too)
+    :return: dict of minion_id -> network.interfaces return. Minions that didn't return map to None
+    '''
+    if isinstance(minion_ids, str):
+        minion_ids = [minion_ids]
+
+    minion_ids = list(minion_ids)
+    if not minion_ids:
+        return {}
+
+    method = 'network.interfaces'
+    res = salt_call(minion_ids, method, [], 'list')
+
+    values = {}
+    for minion_id in minion_ids:
+        ret = _minion_return(res, minion_id, method)
+        values[minion_id] = ret if isinstance(ret, dict) else None
+
+    return values
+
+
+def interface_ip(interfaces, i_faces=PRIVATE_INTERFACES):
+    '''
+    Pick the first IPv4 address off the first of i_faces present in a network.interfaces return
+    '''
     for i in i_faces:
-        res = salt_call(minion_id, method, [i], 'glob')
         try:
-            ip = res[minion_id][method][0]
-        except (KeyError, IndexError):
+            return interfaces[i]['inet'][0]['address']
+        except (KeyError, IndexError, TypeError):
             pass
 
-        if ip:
-            return ip
+    return None
 
-    logger.error('Unable to get the IP address for: %s', minion_id)
-    return ip
 
+def get_private_ip(minion_id):
+    ip = interface_ip(get_interfaces([minion_id]).get(minion_id))
+
+    if not ip:
+        logger.error('Unable to get the IP address for: %s', minion_id)
 
+    return ip
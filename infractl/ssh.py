@@ -1,13 +1,26 @@
 
 import time
 import os
+import json
+import codecs
+import hashlib
+import mmap
+import select
 import logging
 import paramiko
 import socket
+import tempfile
+import threading
 import warnings
 import pprint
+import shlex
+import tarfile
+import gzip
+import zlib
 
 from .exception import InfraCtlSshException
+from .address import get_resolver
+from .util import fan_out, work_queue
 from .config import Config
 cfg = Config()
 
@@ -52,6 +65,32 @@ def connect(ssh, hostname, pkey, user='root', connect_timeout=2, banner_timeout=
     return ssh
 
 
+def set_host_key_policy(ssh, host_key_policy):
+    # https://docs.paramiko.org/en/2.5/api/client.html#paramiko.client.WarningPolicy
+    if host_key_policy.lower() in ('warn', 'warning'):
+        ssh.set_missing_host_key_policy(paramiko.WarningPolicy())
+
+    if host_key_policy.lower() in ('allow', 'autoaddpolicy', 'autoadd'):
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+    if host_key_policy.lower() in ('restrict', 'reject'):
+        ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
+
+    if host_key_policy.lower() in ('missing', 'missinghostkey'):
+        ssh.set_missing_host_key_policy(paramiko.MissingHostKeyPolicy())
+
+
+def load_key(keyfile):
+    try:
+        return paramiko.RSAKey.from_private_key_file(keyfile)
+    except paramiko.PasswordRequiredException as e:
+        logger.error(e)
+    except (IOError, paramiko.SSHException) as e:
+        logger.error(e)
+
+    return None
+
+
 def clean_output(raw_data, _type):
     res = raw_data
 
@@ -64,23 +103,225 @@ def clean_output(raw_data, _type):
     return res
 
 
+class CommandOutput(object):
+    """
+    Collects one stream (stdout or stderr) of a running command as it arrives, a line at a time.
+
+    At most max_bytes are held in memory. Past that the output either goes to a temp file (spill=True, the
+    file path ends up in .path and stays behind for the caller to deal with) or the remainder is dropped and
+    .truncated is set. Looks enough like the paramiko ChannelFile cmd() used to hand back (read/readlines)
+    that clean_output works on it unchanged.
+    """
+    def __init__(self, name, max_bytes=None, spill=False):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.lines = []
+        self.size = 0
+        self.truncated = False
+        self.path = None
+
+        self._file = None
+        self._partial = ''
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def __repr__(self):
+        return '<CommandOutput: {n}, {l} lines, {b} bytes>'.format(n=self.name, l=len(self.lines), b=self.size)
+
+    def feed(self, data, final=False):
+        '''
+        :param data: Bytes read off the channel
+        :param final: No more data is coming, so hand back any trailing line without a newline
+        :return: List of complete lines (newline included) found in data
+        '''
+        text = self._partial + self._decoder.decode(data, final)
+        lines = text.splitlines(True)
+
+        self._partial = ''
+        if lines and not final and not lines[-1].endswith(('\n', '\r')):
+            self._partial = lines.pop()
+
+        for line in lines:
+            self._store(line)
+
+        if final:
+            self.close()
+
+        return lines
+
+    def _store(self, line):
+        # max_bytes caps the encoded size, not the character count, so multibyte output can't run past it
+        self.size += len(line.encode('utf-8'))
+
+        if self._file is not None:
+            self._file.write(line)
+            return
+
+        if self.max_bytes is None or self.size <= self.max_bytes:
+            self.lines.append(line)
+            return
+
+        if self.spill:
+            self._file = tempfile.NamedTemporaryFile('w', prefix='infractl-{n}-'.format(n=self.name),
+                                                     suffix='.log', delete=False)
+            self.path = self._file.name
+            self._file.writelines(self.lines)
+            self._file.write(line)
+            logger.info('%s output passed %d bytes, spilling to %s', self.name, self.max_bytes, self.path)
+        else:
+            self.truncated = True
+
+    def close(self):
+        '''
+        Closes the spill file, if any. feed(final=True) does this too
+        '''
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+
+    def readlines(self):
+        return list(self.lines)
+
+    def read(self):
+        return ''.join(self.lines)
+
+
+def file_sha256(path, buffer_size=1048576):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for data in iter(lambda: fh.read(buffer_size), b''):
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+class _ChannelWriter(object):
+    """
+    The file object tarfile (or a compressor) writes the archive into: every write goes straight down the
+    exec channel, nothing is staged on disk.
+    """
+    def __init__(self, chan):
+        self.chan = chan
+        self.sent = 0
+
+    def write(self, data):
+        self.chan.sendall(data)
+        self.sent += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _drain_channel(chan, err, max_bytes=65536):
+    '''
+    Reads everything the remote side writes until the command exits, keeping the first max_bytes of stderr
+    '''
+    size = 0
+    poll = chan.fileno()
+    while True:
+        if chan.recv_stderr_ready():
+            data = chan.recv_stderr(32768)
+            if size < max_bytes:
+                err.append(data[:max_bytes - size])
+                size += len(data)
+        elif chan.recv_ready():
+            if not chan.recv(32768):
+                break
+        elif chan.exit_status_ready() or chan.closed:
+            break
+        else:
+            select.select([poll], [], [], 0.1)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+
+    return zstandard
+
+
+def choose_compression(paths, link_bps, zstd=False, sample_bytes=4194304, per_file=262144):
+    '''
+    Picks the tar stream compression that should get the data across fastest. A sample spread over the files
+    is compressed with each candidate to get its ratio and speed; a candidate's effective rate is the slower
+    of how fast it compresses and how fast the link moves what it produces. Compression has to win by more
+    than 10% over sending raw bytes to be worth the CPU.
+
+    :param paths: Local files that are going out
+    :param link_bps: Measured (or assumed) link throughput in bytes/second
+    :param zstd: Consider zstd (the zstandard module and a remote zstd are both available)
+    :return: 'none', 'gzip' or 'zstd'
+    '''
+    sample = []
+    size = 0
+    step = max(1, len(paths) // max(1, sample_bytes // per_file))
+    for path in paths[::step]:
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read(per_file)
+        except IOError:
+            continue
+        sample.append(data)
+        size += len(data)
+        if size >= sample_bytes:
+            break
+
+    sample = b''.join(sample)
+    if not sample:
+        return 'none'
+
+    compressors = {'gzip': lambda d: zlib.compress(d, 1)}
+    if zstd:
+        compressors['zstd'] = _zstandard().ZstdCompressor(level=3).compress
+
+    best, best_rate = 'none', link_bps * 1.1
+    for name, compress in compressors.items():
+        start = time.time()
+        ratio = float(len(compress(sample))) / len(sample)
+        speed = len(sample) / max(time.time() - start, 1e-6)
+        rate = min(speed, link_bps / max(ratio, 1e-6))
+        logger.debug('%s: ratio %.2f, %.1f MB/s compressing, %.1f MB/s effective', name, ratio, speed / 1e6,
+                     rate / 1e6)
+        if rate > best_rate:
+            best, best_rate = name, rate
+
+    return best
+
+
 def cb_transfer_progress(done, todo):
-    print("Transferred: {0}\tOut of: {1}".format(done, todo))
+    logger.debug('Transferred: %d\tOut of: %d', done, todo)
 
 
 class InfraCtlSshClient(object):
     """
     Used to provide an interface for basic SSH operations
     """
-    def __init__(self, infra_instance, user='root', keyfile='/root/.ssh/id_rsa', host_key_policy='warning'):
+    def __init__(self, infra_instance, user='root', keyfile='/root/.ssh/id_rsa', host_key_policy='warning',
+                 address=None, use_ip=False, pool=None, connect_timeout=2):
+        '''
+        :param address: Connect to this address instead of the instance's hostname
+        :param use_ip: Resolve the instance's private IP (address.AddressResolver) and connect to that
+        :param pool: Borrow the connection from a sshpool.SshConnectionPool instead of opening our own
+        :param connect_timeout: Seconds to wait on the TCP connect (the pool uses its own setting)
+        '''
         self.infraInstance = infra_instance
         self.username = user
         self.keyfile = keyfile
         self.host_key_policy = host_key_policy
+        self.address = address
+        self.use_ip = use_ip
+        self.pool = pool
+        self.connect_timeout = connect_timeout
         self.client = None
         self.results = None
 
-        self.__setkey()
+        if pool is None:
+            self.__setkey()
 
         self.ssh = paramiko.SSHClient()
 
@@ -90,34 +331,40 @@ class InfraCtlSshClient(object):
         return '<InfraCtlSshClient: {user}@{host}>'.format(user=self.username, host=self.infraInstance.hostname)
 
     def __setpolicy(self):
-        # https://docs.paramiko.org/en/2.5/api/client.html#paramiko.client.WarningPolicy
-        if self.host_key_policy.lower() in ('warn', 'warning'):
-            self.ssh.set_missing_host_key_policy(paramiko.WarningPolicy())
+        set_host_key_policy(self.ssh, self.host_key_policy)
 
-        if self.host_key_policy.lower() in ('allow', 'autoaddpolicy', 'autoadd'):
-            self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        if self.host_key_policy.lower() in ('restrict', 'reject'):
-            self.ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
+    def __setkey(self):
+        self.pkey = load_key(self.keyfile)
 
-        if self.host_key_policy.lower() in ('missing', 'missinghostkey'):
-            self.ssh.set_missing_host_key_policy(paramiko.MissingHostKeyPolicy())
+    @property
+    def host(self):
+        if not self.address and self.use_ip:
+            self.address = get_resolver().resolve_one(self.infraInstance)
 
-    def __setkey(self):
-        try:
-            self.pkey = paramiko.RSAKey.from_private_key_file(self.keyfile)
-        except paramiko.PasswordRequiredException as e:
-            logger.error(e)
-        except (IOError, paramiko.SSHException) as e:
-            logger.error(e)
+        return self.address or self.infraInstance.hostname
 
     def connect(self):
         try:
-            self.client = connect(self.ssh, self.infraInstance.hostname, self.pkey, self.username)
+            if self.pool is not None:
+                self.client = self.pool.get(self.host, self.username, self.keyfile)
+            else:
+                self.client = connect(self.ssh, self.host, self.pkey, self.username,
+                                      connect_timeout=self.connect_timeout)
             logger.info('Connected: %s', self)
         except InfraCtlSshException:
             pass
 
+    def close(self):
+        if self.client is None:
+            return
+
+        if self.pool is not None:
+            self.pool.release(self.host, self.username, self.keyfile)
+        else:
+            self.client.close()
+
+        self.client = None
+
     def wait_for_connection(self, interval=2, timeout=120):
         expiration = time.time() + timeout
         while not self.client and time.time() < expiration:
@@ -129,19 +376,76 @@ class InfraCtlSshClient(object):
 
         return True
 
-    def cmd(self, cmd):
+    def iter_cmd(self, cmd, timeout=None, max_bytes=None, spill=False, bufsize=32768):
+        '''
+        Runs cmd and yields ('stdout' or 'stderr', line) as the remote side produces them. Both streams are
+        drained while the command runs, so chatty commands can't fill the channel window and stall.
+        self.results is filled in (same shape cmd() returns) once the generator is exhausted.
+
+        :param timeout: Seconds the whole command may take
+        :param max_bytes: Most output kept in memory per stream (None for no limit)
+        :param spill: Past max_bytes, write the stream to a temp file instead of dropping it
+        '''
+        out = CommandOutput('stdout', max_bytes, spill)
+        err = CommandOutput('stderr', max_bytes, spill)
+
+        chan = None
         try:
-            (stdin, stdout, stderr) = self.client.exec_command(cmd)
-            exit_code = stdout.channel.recv_exit_status()
+            chan = self.client.get_transport().open_session(timeout=timeout)
+            chan.exec_command(cmd)
+            poll = chan.fileno()
+
+            expiration = time.time() + timeout if timeout else None
+            while True:
+                # checked first on every pass: a command that never stops printing (yes, tail -f) must still
+                # hit the deadline
+                if expiration and time.time() > expiration:
+                    raise paramiko.SSHException('Command did not finish within {t} seconds: {c}'.format(t=timeout,
+                                                                                                       c=cmd))
+
+                busy = False
+
+                if chan.recv_ready():
+                    busy = True
+                    for line in out.feed(chan.recv(bufsize)):
+                        yield 'stdout', line
+
+                if chan.recv_stderr_ready():
+                    busy = True
+                    for line in err.feed(chan.recv_stderr(bufsize)):
+                        yield 'stderr', line
+
+                if busy:
+                    continue
+
+                if chan.exit_status_ready() and chan.eof_received:
+                    break
+
+                # the channel's pipe turns readable on new data for either stream
+                select.select([poll], [], [], 0.1)
+
+            for stream, name in ((out, 'stdout'), (err, 'stderr')):
+                for line in stream.feed(b'', final=True):
+                    yield name, line
+
+            exit_code = chan.recv_exit_status()
 
             self.results = {
                 'exit_code': exit_code,
                 'msg': {
-                    'stdout': clean_output(stdout, 'stdout'),
-                    'stderr': clean_output(stderr, 'stderr')
+                    'stdout': clean_output(out, 'stdout'),
+                    'stderr': clean_output(err, 'stderr')
                 }
             }
 
+            truncated = [s.name for s in (out, err) if s.truncated]
+            if truncated:
+                self.results['truncated'] = truncated
+
+            spilled = dict((s.name, s.path) for s in (out, err) if s.path)
+            if spilled:
+                self.results['spill'] = spilled
+
         except paramiko.SSHException as e:
             logger.error(e)
             self.results = {
@@ -152,6 +456,24 @@ class InfraCtlSshClient(object):
                 }
             }
 
+        finally:
+            # also runs when the caller stops iterating early (break, close(), an exception in the loop body),
+            # so an abandoned command doesn't leave its channel open on the transport
+            if chan is not None:
+                chan.close()
+            out.close()
+            err.close()
+
+    def cmd(self, cmd, timeout=None, on_line=None, max_bytes=None, spill=False):
+        '''
+        :param on_line: Called as on_line(stream, line) for each line while the command runs
+        :return: {'exit_code': int, 'msg': {'stdout': ..., 'stderr': ...}} plus 'truncated' and/or 'spill'
+            when max_bytes was hit
+        '''
+        for stream, line in self.iter_cmd(cmd, timeout=timeout, max_bytes=max_bytes, spill=spill):
+            if on_line is not None:
+                on_line(stream, line)
+
         return self.results
 
 
@@ -160,37 +482,664 @@ class InfraCtlSFTPClient(object):
     For Uploading/Downloading files and directories. This is/was originally created to handle recursion.
     In order for upoading/downloading to work like 'shutil' methods (handling the recursion) we need to
     do a bit more work.
+
+    sshclient may be a connected paramiko.SSHClient or InfraCtlSshClient. Leave it out and hand over a
+    sshpool.SshConnectionPool instead to have the SFTP channel opened on a pooled connection.
     """
-    def __init__(self, infra_instance, sshclient, user='root', keyfile='/root/.ssh/id_rsa'):
+    def __init__(self, infra_instance, sshclient=None, user='root', keyfile='/root/.ssh/id_rsa', pool=None):
         self.infraInstance = infra_instance
         self.username = user
         self.keyfile = keyfile
 
+        if isinstance(sshclient, InfraCtlSshClient):
+            sshclient = sshclient.client
+
+        self.pool = None
+        if sshclient is None:
+            if pool is None:
+                raise InfraCtlSshException('{s} needs either a connected ssh client or a pool'.format(s=self))
+            sshclient = pool.get(infra_instance.hostname, user, keyfile)
+            self.pool = pool
+
         self.client = sshclient.open_sftp()
         self.client.sshclient = sshclient
 
     def __repr__(self):
         return '<InfraCtlSFTPClient: {user}@{host}>'.format(user=self.username, host=self.infraInstance.hostname)
 
-    def upload(self, source, target):
-        self._mkdir(target, ignore_existing=True)
+    def close(self):
+        self.client.close()
 
-        return self._put_dir(source, target)
+        if self.pool is not None:
+            self.pool.release(self.infraInstance.hostname, self.username, self.keyfile)
+            self.pool = None
 
-    # Credit: https://stackoverflow.com/questions/4409502/directory-transfers-on-paramiko for the original
-    # idea/implementation
-    def _put_dir(self, source, target):
-        """
-        Uploads the contents of the source directory to the target path. The
-        target directory needs to exists. All subdirectories in source are
-        created under target.
-        """
-        for item in os.listdir(source):
-            if os.path.isfile(os.path.join(source, item)):
-                self.client.put(os.path.join(source, item), '%s/%s' % (target, item), callback=cb_transfer_progress)
+    def upload(self, source, target, workers=None, buffer_size=None, callback=None, sync=False, delete=False,
+               checksum=False, manifest=None, mode='sftp', compression='auto', progress=None):
+        '''
+        Recursively uploads the contents of source into target. The local tree is walked once, every remote
+        directory is created in a single remote command, then the files go out over several SFTP channels
+        sharing this connection, with pipelined writes so each file costs one round trip rather than one per
+        chunk. A file that fails is recorded and the rest carry on.
+
+        With sync, only files that are new or differ from what's on the remote side are sent. The remote
+        state comes from one find over target (or from a manifest file written by the previous sync, which
+        skips the remote scan entirely). Files match when size and mtime (to the second) agree, or size and
+        sha256 with checksum. Uploaded files get the local mtime so the next sync sees them as unchanged.
+
+        :param workers: Concurrent SFTP channels (cfg.sftp_workers)
+        :param buffer_size: Bytes read and written per call (cfg.sftp_buffer_size)
+        :param callback: Called as callback(bytes_done, bytes_total) for each file as it goes
+        :param sync: Only send new and changed files
+        :param delete: With sync, remove remote files that aren't in source
+        :param checksum: With sync, compare content hashes instead of mtimes
+        :param manifest: With sync, local path of a manifest to read the remote state from (when it exists
+            and was written for this host/target) and to write the new state to afterwards
+        :param mode: 'sftp' for per-file transfers, 'tar' to stream everything as one tar archive into a
+            remote "tar -x" (far fewer round trips for trees of small files; see put_tar)
+        :param compression: With tar, 'none', 'gzip', 'zstd' or 'auto'
+        :param progress: progress.TransferProgress to count this upload in
+        :return: {'files': int, 'bytes': int, 'failed': {relative path: error}, 'elapsed': seconds} plus
+            'skipped' and 'deleted' counts with sync
+        '''
+        start = time.time()
+        workers = workers or cfg.sftp_workers
+        buffer_size = buffer_size or cfg.sftp_buffer_size
+
+        dirs, files = self._walk(source)
+        self._mkdirs([target] + ['%s/%s' % (target, d) for d in dirs])
+
+        results = {'files': 0, 'bytes': 0, 'failed': {}}
+
+        if sync:
+            local_state = dict((rel, {'size': size, 'mtime': mtime}) for rel, size, mtime in files)
+            remote_state = self._read_manifest(manifest, target) if manifest else None
+            if remote_state is None:
+                remote_state = self.remote_manifest(target, checksum=checksum)
+
+            todo = []
+            for item in files:
+                rel = item[0]
+                if self._changed(os.path.join(source, rel), local_state[rel], remote_state.get(rel), checksum):
+                    todo.append(item)
+            results['skipped'] = len(files) - len(todo)
+            files = todo
+
+            extras = [rel for rel in remote_state if rel not in local_state]
+            results['deleted'] = 0
+            if delete and extras:
+                results['deleted'] = self._remove(target, extras)
+
+        if mode == 'tar':
+            sent, results['bytes'], results['failed'] = self.put_tar(source, target, files, compression=compression,
+                                                                     callback=callback, progress=progress)
+            results['files'] = len(sent)
+            files = []
+
+        host = self.infraInstance.hostname
+        if progress is not None and files:
+            progress.add_total(sum(f[1] for f in files), len(files), host)
+
+        transport = self.client.sshclient.get_transport()
+        local = threading.local()
+        channels = []
+
+        def put(item):
+            rel, size, mtime = item
+            if not hasattr(local, 'sftp'):
+                local.sftp = paramiko.SFTPClient.from_transport(transport)
+                channels.append(local.sftp)
+
+            remote_path = '%s/%s' % (target, rel)
+            self._put_file(local.sftp, os.path.join(source, rel), remote_path, size, buffer_size, callback,
+                           progress, host)
+            if sync:
+                local.sftp.utime(remote_path, (mtime, mtime))
+            return size
+
+        try:
+            for (rel, size, mtime), sent, error in work_queue(files, put, workers):
+                if error is not None:
+                    logger.error('%s: failed to upload %s: %s', self, rel, error)
+                    results['failed'][rel] = str(error)
+                else:
+                    results['files'] += 1
+                    results['bytes'] += sent
+
+                if progress is not None:
+                    progress.file_done(host, failed=error is not None)
+        finally:
+            for sftp in channels:
+                sftp.close()
+
+        if sync and manifest:
+            for rel in results['failed']:
+                local_state.pop(rel, None)
+            self._write_manifest(manifest, target, local_state)
+
+        results['elapsed'] = time.time() - start
+        logger.info('%s: uploaded %d files (%d bytes) to %s in %.1fs, %d failed', self, results['files'],
+                    results['bytes'], target, results['elapsed'], len(results['failed']))
+
+        return results
+
+    def put_tar(self, source, target, files, compression='auto', callback=None, progress=None):
+        '''
+        Streams files (relative paths under source, as from _walk) to target as a tar archive built on the fly
+        and fed straight into "tar -x" on the remote side. Directory entries aren't sent: the remote tar
+        creates whatever parents it needs.
+
+        :param compression: 'none', 'gzip', 'zstd' (needs the zstandard module locally and zstd remotely) or
+            'auto' to pick from the link speed and a compressibility sample (choose_compression)
+        :param callback: Called as callback(bytes_done, bytes_total) after each file, counting file bytes
+        :param progress: progress.TransferProgress to count the files in. Bytes are counted as they go into the
+            stream, files only once the remote tar has exited cleanly
+        :return: (files sent, bytes of file data sent, {relative path: error})
+        '''
+        if not files:
+            return [], 0, {}
+
+        if compression == 'zstd':
+            if _zstandard() is None:
+                raise InfraCtlSshException('zstd tar compression needs the zstandard module')
+            # checked up front: finding out from a broken pipe halfway through the stream tells nobody anything
+            if self.exec_command('command -v zstd')[0] != 0:
+                raise InfraCtlSshException('zstd tar compression needs zstd on {h}'.format(
+                    h=self.infraInstance.hostname))
+
+        if compression == 'auto':
+            zstd = _zstandard() is not None and self.exec_command('command -v zstd')[0] == 0
+            compression = choose_compression([os.path.join(source, f[0]) for f in files], self.link_speed(),
+                                             zstd=zstd)
+
+        extract = 'tar -x --no-same-owner -f - -C {t}'.format(t=shlex.quote(target))
+        if compression == 'gzip':
+            extract = 'gzip -dc | ' + extract
+        elif compression == 'zstd':
+            extract = 'zstd -dcq | ' + extract
+        elif compression != 'none':
+            raise InfraCtlSshException('Unknown tar compression: {c}'.format(c=compression))
+
+        total = sum(f[1] for f in files)
+        done = 0
+        sent = []
+        failed = {}
+
+        host = self.infraInstance.hostname
+        if progress is not None:
+            progress.add_total(total, len(files), host)
+
+        chan = self.client.sshclient.get_transport().open_session()
+        err = []
+        drain = threading.Thread(target=_drain_channel, args=(chan, err))
+        drain.daemon = True
+        try:
+            chan.exec_command(extract)
+            wire = _ChannelWriter(chan)
+
+            # remote tar complaining (a permission error per file, say) must never fill the channel window,
+            # or it stops reading the archive and our sends block forever
+            drain.start()
+
+            if compression == 'gzip':
+                stream = gzip.GzipFile(fileobj=wire, mode='wb', compresslevel=1)
+            elif compression == 'zstd':
+                stream = _zstandard().ZstdCompressor(level=3).stream_writer(wire, closefd=False)
             else:
-                self._mkdir('%s/%s' % (target, item), ignore_existing=True)
-                self._put_dir(os.path.join(source, item), '%s/%s' % (target, item))
+                stream = wire
+
+            with tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                for item in files:
+                    rel = item[0]
+                    path = os.path.join(source, rel)
+                    fh = None
+                    try:
+                        info = tar.gettarinfo(path, arcname=rel)
+                        if info is None:
+                            raise IOError('unsupported file type: {p}'.format(p=path))
+                        if info.isreg():
+                            fh = open(path, 'rb')
+                    except (IOError, OSError) as e:
+                        # nothing of this file is in the stream yet, so it can be skipped on its own
+                        logger.error('%s: failed to add %s to the tar stream: %s', self, rel, e)
+                        failed[rel] = str(e)
+                        if progress is not None:
+                            progress.file_done(host, failed=True)
+                        continue
+
+                    # once the header is out the member has to be written to its full declared size. A short
+                    # member would throw the remote tar off for everything after it, so a read error (or the
+                    # file shrinking) from here on aborts the whole stream
+                    try:
+                        tar.addfile(info, fh)
+                    except (IOError, OSError) as e:
+                        if chan.closed or chan.exit_status_ready():
+                            raise
+                        raise InfraCtlSshException('{r} failed partway into the tar stream: {e}'.format(r=rel,
+                                                                                                       e=e))
+                    finally:
+                        if fh is not None:
+                            fh.close()
+
+                    sent.append(rel)
+                    done += item[1]
+                    if callback is not None:
+                        callback(done, total)
+                    if progress is not None:
+                        progress.update(item[1], host)
+
+            if stream is not wire:
+                stream.close()
+            chan.shutdown_write()
+
+            drain.join()
+            exit_code = chan.recv_exit_status()
+        except InfraCtlSshException as e:
+            # aborted on our side, the remote tar is still waiting for the rest of the archive
+            chan.close()
+            exit_code = None
+            error = str(e)
+        except (socket.error, paramiko.SSHException) as e:
+            # usually the remote side died first; let its last words in ahead of ours
+            if drain.ident is not None:
+                drain.join(5)
+            exit_code = 255
+            err.append(str(e).encode('utf-8'))
+        finally:
+            chan.close()
+
+        if exit_code != 0:
+            if exit_code is not None:
+                error = 'remote tar exited {c}: {e}'.format(c=exit_code,
+                                                             e=b''.join(err).decode('utf-8', 'replace').strip())
+            logger.error('%s: %s', self, error)
+            # nothing is known to have landed, including files we never got to
+            lost = [f[0] for f in files if f[0] not in failed]
+            for rel in lost:
+                failed[rel] = error
+            if progress is not None:
+                progress.rollback(done, host)
+                for _ in lost:
+                    progress.file_done(host, failed=True)
+            return [], 0, failed
+
+        if progress is not None:
+            for _ in sent:
+                progress.file_done(host)
+
+        logger.info('%s: streamed %d files (%d bytes, %d on the wire, %s) to %s', self, len(sent), done, wire.sent,
+                    compression, target)
+
+        return sent, done, failed
+
+    def put_large(self, local_path, remote_path, chunk_size=None, workers=None, buffer_size=None, journal=None,
+                  verify=True, callback=None, progress=None):
+        '''
+        Sends one big file as fixed size ranges written concurrently at their offsets, each over its own SFTP
+        channel. Finished ranges are recorded in a journal, so after a dropped connection the same call picks
+        up with the ranges that are still missing (provided the local file hasn't changed). Once everything is
+        across, a single remote sha256sum is checked against the local digest.
+
+        :param chunk_size: Bytes per range (cfg.sftp_chunk_size)
+        :param workers: Ranges in flight at once (cfg.sftp_workers)
+        :param buffer_size: Bytes per pipelined write (cfg.sftp_buffer_size)
+        :param journal: Path of the resume journal. Defaults to one under cfg.sftp_journal_dir named for this
+            host and remote_path
+        :param verify: Compare checksums at the end
+        :param callback: Called as callback(bytes_done, bytes_total) as ranges finish
+        :param progress: progress.TransferProgress to count this file in
+        :return: {'bytes': int sent this time, 'chunks': int, 'resumed': int chunks already there,
+            'sha256': str or None, 'elapsed': seconds}
+        '''
+        start = time.time()
+        chunk_size = chunk_size or cfg.sftp_chunk_size
+        workers = workers or cfg.sftp_workers
+        buffer_size = buffer_size or cfg.sftp_buffer_size
+
+        st = os.stat(local_path)
+        size = st.st_size
+        chunks = [(i, offset, min(chunk_size, size - offset)) for i, offset in enumerate(range(0, size, chunk_size))]
+
+        if journal is None:
+            key = hashlib.sha1('{h}:{p}'.format(h=self.infraInstance.hostname, p=remote_path).encode('utf-8'))
+            journal = os.path.join(os.path.expanduser(cfg.sftp_journal_dir), key.hexdigest() + '.json')
+
+        state = {
+            'source': os.path.abspath(local_path),
+            'size': size,
+            'mtime': st.st_mtime,
+            'host': self.infraInstance.hostname,
+            'target': remote_path,
+            'chunk_size': chunk_size,
+            'done': [],
+        }
+        state['done'] = self._resume_state(journal, state, remote_path)
+        resumed = len(state['done'])
+
+        if not state['done']:
+            with self.client.open(remote_path, 'wb') as fr:
+                fr.truncate(size)
+            self._write_journal(journal, state)
+
+        todo = [c for c in chunks if c[0] not in state['done']]
+        total = sum(c[2] for c in todo)
+
+        host = self.infraInstance.hostname
+        if progress is not None:
+            progress.add_total(total, 1, host)
+        done = [0]
+        lock = threading.Lock()
+        transport = self.client.sshclient.get_transport()
+        local = threading.local()
+        channels = []
+
+        with open(local_path, 'rb') as fl:
+            data = mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            view = memoryview(data)
+
+            def put(chunk):
+                idx, offset, length = chunk
+                if not hasattr(local, 'sftp'):
+                    local.sftp = paramiko.SFTPClient.from_transport(transport)
+                    channels.append(local.sftp)
+
+                with local.sftp.open(remote_path, 'r+b', bufsize=buffer_size) as fr:
+                    fr.seek(offset)
+                    fr.set_pipelined(True)
+                    for pos in range(offset, offset + length, buffer_size):
+                        fr.write(view[pos:min(pos + buffer_size, offset + length)])
+
+                with lock:
+                    state['done'].append(idx)
+                    self._write_journal(journal, state)
+                    done[0] += length
+                    if callback is not None:
+                        callback(done[0], total)
+                if progress is not None:
+                    progress.update(length, host)
+
+                return length
+
+            failed = {}
+            try:
+                for (idx, offset, length), _, error in fan_out(todo, put, max_workers=workers):
+                    if error is not None:
+                        logger.error('%s: range %d (%d bytes at %d) of %s failed: %s', self, idx, length, offset,
+                                     local_path, error)
+                        failed[idx] = str(error)
+            finally:
+                for sftp in channels:
+                    sftp.close()
+                view.release()
+                if size:
+                    data.close()
+
+        if failed:
+            if progress is not None:
+                progress.file_done(host, failed=True)
+            raise InfraCtlSshException('{n} of {t} ranges of {f} failed, run again to resume (journal: {j})'.format(
+                n=len(failed), t=len(chunks), f=local_path, j=journal))
+
+        digest = None
+        if verify:
+            digest = file_sha256(local_path)
+            exit_code, out, err = self.exec_command('sha256sum -- {p}'.format(p=shlex.quote(remote_path)))
+            remote_digest = out.split(b' ', 1)[0].decode('ascii', 'replace')
+            if exit_code != 0 or remote_digest != digest:
+                self._remove_journal(journal)
+                if progress is not None:
+                    progress.rollback(done[0], host)
+                    progress.file_done(host, failed=True)
+                raise InfraCtlSshException('Checksum mismatch for {f} -> {h}:{p} (local {l}, remote {r}{e})'.format(
+                    f=local_path, h=self.infraInstance.hostname, p=remote_path, l=digest, r=remote_digest or '?',
+                    e=', ' + err.decode('utf-8', 'replace').strip() if exit_code else ''))
+
+        self._remove_journal(journal)
+        if progress is not None:
+            progress.file_done(host)
+
+        results = {
+            'bytes': done[0],
+            'chunks': len(chunks),
+            'resumed': resumed,
+            'sha256': digest,
+            'elapsed': time.time() - start,
+        }
+        logger.info('%s: sent %s -> %s (%d bytes in %d ranges, %d resumed) in %.1fs', self, local_path,
+                    remote_path, size, len(chunks), resumed, results['elapsed'])
+
+        return results
+
+    def _resume_state(self, journal, state, remote_path):
+        '''
+        :return: Chunk indexes a previous run already finished, or [] when there's nothing usable to resume
+        '''
+        try:
+            with open(journal) as fh:
+                previous = json.load(fh)
+        except (IOError, ValueError):
+            return []
+
+        for key in ('source', 'size', 'mtime', 'host', 'target', 'chunk_size'):
+            if previous.get(key) != state[key]:
+                logger.info('Journal %s no longer matches (%s changed), starting over', journal, key)
+                return []
+
+        try:
+            if self.client.stat(remote_path).st_size != state['size']:
+                return []
+        except IOError:
+            return []
+
+        logger.info('Resuming %s with %d ranges already sent', remote_path, len(previous['done']))
+        return previous['done']
+
+    @staticmethod
+    def _write_journal(journal, state):
+        directory = os.path.dirname(journal)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tmp = journal + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(state, fh)
+        os.replace(tmp, journal)
+
+    @staticmethod
+    def _remove_journal(journal):
+        try:
+            os.unlink(journal)
+        except OSError:
+            pass
+
+    def link_speed(self, probe_bytes=1048576):
+        '''
+        Rough throughput of this connection in bytes/second, measured once by pushing probe_bytes of random
+        data into "cat > /dev/null"
+        '''
+        if getattr(self, '_link_bps', None) is None:
+            start = time.time()
+            self.exec_command('cat > /dev/null', stdin=os.urandom(probe_bytes))
+            self._link_bps = probe_bytes / max(time.time() - start, 1e-6)
+            logger.debug('%s: link measured at %.1f MB/s', self, self._link_bps / 1e6)
+
+        return self._link_bps
+
+    def remote_manifest(self, target, checksum=False):
+        '''
+        Lists every file under target in one remote command.
+
+        :return: {relative path: {'size': int, 'mtime': float}} ('sha256' added with checksum). Empty when
+            target doesn't exist yet
+        '''
+        cmd = "cd {t} 2>/dev/null || exit 0; find . -type f -printf '%P\\t%s\\t%T@\\0'".format(
+            t=shlex.quote(target))
+        if checksum:
+            cmd += " && printf '\\0--sha256--\\0' && find . -type f -print0 | xargs -0 -r sha256sum"
+
+        exit_code, out, err = self.exec_command(cmd)
+        if exit_code != 0:
+            raise InfraCtlSshException('Unable to list {t} on {h}: {e}'.format(
+                t=target, h=self.infraInstance.hostname, e=err.decode('utf-8', 'replace').strip()))
+
+        listing, _, sums = out.partition(b'\0--sha256--\0')
+
+        state = {}
+        for record in listing.split(b'\0'):
+            if not record:
+                continue
+            rel, size, mtime = record.decode('utf-8', 'surrogateescape').rsplit('\t', 2)
+            state[rel] = {'size': int(size), 'mtime': float(mtime)}
+
+        for line in sums.decode('utf-8', 'surrogateescape').splitlines():
+            # sha256sum escapes awkward names with a leading backslash; those just fall back to mtime
+            digest, _, path = line.partition('  ./')
+            if path in state:
+                state[path]['sha256'] = digest
+
+        return state
+
+    @staticmethod
+    def _changed(local_path, local, remote, checksum):
+        if remote is None or local['size'] != remote['size']:
+            return True
+
+        if checksum and remote.get('sha256'):
+            if 'sha256' not in local:
+                local['sha256'] = file_sha256(local_path)
+            return local['sha256'] != remote['sha256']
+
+        return int(local['mtime']) != int(remote['mtime'])
+
+    def _remove(self, target, paths):
+        stdin = b''.join(p.encode('utf-8', 'surrogateescape') + b'\0' for p in paths)
+        exit_code, _, err = self.exec_command('cd {t} && xargs -0 rm -f --'.format(t=shlex.quote(target)),
+                                              stdin=stdin)
+        if exit_code != 0:
+            logger.error('%s: removing %d extra files from %s failed: %s', self, len(paths), target,
+                         err.decode('utf-8', 'replace').strip())
+            return 0
+
+        logger.info('%s: removed %d extra files from %s', self, len(paths), target)
+        return len(paths)
+
+    def _read_manifest(self, path, target):
+        try:
+            with open(path) as fh:
+                manifest = json.load(fh)
+        except (IOError, ValueError) as e:
+            logger.debug('Not using manifest %s: %s', path, e)
+            return None
+
+        if manifest.get('host') != self.infraInstance.hostname or manifest.get('target') != target:
+            logger.info('Manifest %s is for %s:%s, scanning the remote side instead', path, manifest.get('host'),
+                        manifest.get('target'))
+            return None
+
+        return manifest['files']
+
+    def _write_manifest(self, path, target, files):
+        try:
+            with open(path, 'w') as fh:
+                json.dump({'host': self.infraInstance.hostname, 'target': target, 'files': files}, fh)
+        except IOError as e:
+            logger.warning('Unable to write manifest %s: %s', path, e)
+
+    @staticmethod
+    def _walk(source):
+        '''
+        :return: (directories, [(file, size, mtime), ...]), both relative to source with '/' separators,
+            parents before children
+        '''
+        dirs = []
+        files = []
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            with os.scandir(os.path.join(source, rel)) as it:
+                for entry in it:
+                    path = rel + '/' + entry.name if rel else entry.name
+                    if entry.is_dir():
+                        dirs.append(path)
+                        stack.append(path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        files.append((path, st.st_size, st.st_mtime))
+
+        return dirs, files
+
+    @staticmethod
+    def _put_file(sftp, local_path, remote_path, size, buffer_size, callback=None, progress=None, host=None):
+        done = 0
+        try:
+            with open(local_path, 'rb') as fl:
+                with sftp.open(remote_path, 'wb', bufsize=buffer_size) as fr:
+                    fr.set_pipelined(True)
+                    while True:
+                        data = fl.read(buffer_size)
+                        if not data:
+                            break
+                        fr.write(data)
+                        done += len(data)
+                        if callback is not None:
+                            callback(done, size)
+                        if progress is not None:
+                            progress.update(len(data), host)
+        except Exception:
+            # a half written file doesn't count towards the totals
+            if progress is not None:
+                progress.rollback(done, host)
+            raise
+
+        return done
+
+    def exec_command(self, cmd, stdin=None):
+        '''
+        Runs cmd on the connection the SFTP session lives on.
+
+        :param stdin: Bytes to feed the command
+        :return: (exit_code, stdout bytes, stderr bytes)
+        '''
+        chan = self.client.sshclient.get_transport().open_session()
+        try:
+            chan.exec_command(cmd)
+            if stdin:
+                chan.sendall(stdin)
+            chan.shutdown_write()
+
+            out = []
+            err = []
+            while not (chan.exit_status_ready() and chan.eof_received) or chan.recv_ready() or \
+                    chan.recv_stderr_ready():
+                if chan.recv_ready():
+                    out.append(chan.recv(32768))
+                elif chan.recv_stderr_ready():
+                    err.append(chan.recv_stderr(32768))
+                else:
+                    time.sleep(0.01)
+
+            return chan.recv_exit_status(), b''.join(out), b''.join(err)
+        finally:
+            chan.close()
+
+    def _mkdirs(self, paths):
+        '''
+        Creates every path (and any missing parents) with one remote "mkdir -p", falling back to a SFTP mkdir per
+        path when the remote side can't run it.
+        '''
+        stdin = b''.join(p.encode('utf-8') + b'\0' for p in paths)
+        try:
+            exit_code, _, err = self.exec_command('xargs -0 mkdir -p --', stdin=stdin)
+        except paramiko.SSHException as e:
+            exit_code, err = 255, str(e).encode('utf-8')
+
+        if exit_code == 0:
+            return
+
+        logger.warning('%s: batched mkdir failed (%s), creating directories one at a time', self,
+                       err.decode('utf-8', 'replace').strip())
+        for path in paths:
+            self._mkdir(path, ignore_existing=True)
 
     def _mkdir(self, path, mode=511, ignore_existing=False):
         try:
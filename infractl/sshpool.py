@@ -0,0 +1,221 @@
+import logging
+import threading
+import time
+import paramiko
+
+from contextlib import contextmanager
+
+from .ssh import connect, set_host_key_policy, load_key
+from .exception import InfraCtlSshException
+from .config import Config
+
+cfg = Config()
+
+logger = logging.getLogger(__name__)
+
+
+class _PooledConnection(object):
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.created = time.time()
+        self.last_used = self.created
+        self.leases = 0
+
+    def __repr__(self):
+        return '<PooledConnection: {user}@{host} ({n} lease(s))>'.format(
+            host=self.key[0], user=self.key[1], n=self.leases)
+
+    def is_alive(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+class SshConnectionPool(object):
+    """
+    Keeps authenticated SSH connections around, keyed by (host, user, keyfile), so talking to the same
+    host again skips the TCP connect, key exchange and auth. Connections get a keepalive so idle ones
+    aren't dropped by NAT/firewalls, and are evicted once idle for idle_timeout seconds or found dead.
+
+    A connection may be leased by several callers at once - exec and SFTP channels multiplex over the same
+    transport. At most max_connections are held; when full, the least recently used idle connection is
+    evicted, or we wait (up to wait_timeout) for one to become idle.
+    """
+    def __init__(self, max_connections=None, idle_timeout=None, keepalive=None, wait_timeout=None,
+                 host_key_policy='warning', connect_timeout=2):
+        self.max_connections = max_connections or cfg.ssh_pool_max_connections
+        self.idle_timeout = idle_timeout if idle_timeout is not None else cfg.ssh_pool_idle_timeout
+        self.keepalive = keepalive if keepalive is not None else cfg.ssh_keepalive
+        self.wait_timeout = wait_timeout if wait_timeout is not None else cfg.ssh_pool_wait_timeout
+        self.host_key_policy = host_key_policy
+        self.connect_timeout = connect_timeout
+
+        self._cond = threading.Condition()
+        self._connections = {}
+        self._connecting = set()
+        self._keys = {}
+        self._stats = {'hits': 0, 'misses': 0, 'evicted_idle': 0, 'evicted_dead': 0, 'evicted_full': 0,
+                       'waits': 0}
+
+    def __repr__(self):
+        return '<SshConnectionPool: {n}/{m} connection(s)>'.format(n=len(self._connections), m=self.max_connections)
+
+    def _pkey(self, keyfile):
+        if keyfile not in self._keys:
+            self._keys[keyfile] = load_key(keyfile)
+
+        return self._keys[keyfile]
+
+    def get(self, host, user='root', keyfile='/root/.ssh/id_rsa'):
+        '''
+        Lease a connected paramiko.SSHClient, connecting if we don't already hold a live one.
+        Hand it back with release() (or use lease()).
+        :return: paramiko.SSHClient
+        '''
+        key = (host, user, keyfile)
+        deadline = time.time() + self.wait_timeout
+
+        with self._cond:
+            while True:
+                self._evict()
+
+                conn = self._connections.get(key)
+                if conn is not None:
+                    self._stats['hits'] += 1
+                    conn.leases += 1
+                    conn.last_used = time.time()
+                    return conn.client
+
+                # someone else is already connecting to this host; wait for them rather than racing
+                if key not in self._connecting and \
+                        (len(self._connections) + len(self._connecting) < self.max_connections or self._evict_lru()):
+                    self._connecting.add(key)
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise InfraCtlSshException('No free connection for {u}@{h} after {t} seconds ({p})'.format(
+                        u=user, h=host, t=self.wait_timeout, p=self))
+
+                self._stats['waits'] += 1
+                self._cond.wait(remaining)
+
+            self._stats['misses'] += 1
+            pkey = self._pkey(keyfile)
+
+        # connect outside the lock, other hosts shouldn't wait on our handshake
+        try:
+            ssh = paramiko.SSHClient()
+            set_host_key_policy(ssh, self.host_key_policy)
+            connect(ssh, host, pkey, user, connect_timeout=self.connect_timeout)
+
+            if self.keepalive:
+                ssh.get_transport().set_keepalive(self.keepalive)
+        except Exception:
+            with self._cond:
+                self._connecting.discard(key)
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self._connecting.discard(key)
+            conn = _PooledConnection(key, ssh)
+            conn.leases = 1
+            self._connections[key] = conn
+            self._cond.notify_all()
+
+        logger.debug('Pooled new connection: %s', conn)
+        return ssh
+
+    def release(self, host, user='root', keyfile='/root/.ssh/id_rsa'):
+        with self._cond:
+            conn = self._connections.get((host, user, keyfile))
+            if conn is not None and conn.leases > 0:
+                conn.leases -= 1
+                conn.last_used = time.time()
+            self._cond.notify_all()
+
+    @contextmanager
+    def lease(self, host, user='root', keyfile='/root/.ssh/id_rsa'):
+        client = self.get(host, user, keyfile)
+        try:
+            yield client
+        finally:
+            self.release(host, user, keyfile)
+
+    def open_session(self, host, user='root', keyfile='/root/.ssh/id_rsa'):
+        '''
+        Open a new exec channel on the pooled connection. The connection stays leased until release()
+        :return: paramiko.Channel
+        '''
+        return self.get(host, user, keyfile).get_transport().open_session()
+
+    def open_sftp(self, host, user='root', keyfile='/root/.ssh/id_rsa'):
+        '''
+        Open a new SFTP channel on the pooled connection. The connection stays leased until release()
+        :return: paramiko.SFTPClient
+        '''
+        return paramiko.SFTPClient.from_transport(self.get(host, user, keyfile).get_transport())
+
+    def _drop(self, key, stat):
+        conn = self._connections.pop(key)
+        self._stats[stat] += 1
+        try:
+            conn.client.close()
+        except Exception as e:
+            logger.debug('Error closing %s: %s', conn, e)
+
+    def _evict(self):
+        now = time.time()
+        for key, conn in list(self._connections.items()):
+            if not conn.is_alive():
+                logger.debug('Evicting dead connection: %s', conn)
+                self._drop(key, 'evicted_dead')
+            elif not conn.leases and self.idle_timeout and now - conn.last_used > self.idle_timeout:
+                logger.debug('Evicting idle connection: %s', conn)
+                self._drop(key, 'evicted_idle')
+
+    def _evict_lru(self):
+        idle = [c for c in self._connections.values() if not c.leases]
+        if not idle:
+            return False
+
+        self._drop(min(idle, key=lambda c: c.last_used).key, 'evicted_full')
+        return True
+
+    def evict_idle(self):
+        with self._cond:
+            self._evict()
+
+    def close(self):
+        with self._cond:
+            for key in list(self._connections):
+                self._drop(key, 'evicted_idle')
+
+    def stats(self):
+        '''
+        :return: dict of hit/miss/eviction counters plus the current pool size and leases out
+        '''
+        with self._cond:
+            stats = dict(self._stats)
+            stats['connections'] = len(self._connections)
+            stats['leased'] = sum(1 for c in self._connections.values() if c.leases)
+            stats['max_connections'] = self.max_connections
+
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    '''
+    :return: The shared SshConnectionPool for this process
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SshConnectionPool()
+
+    return _pool
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .sodium import find_minions, dict_to_grain_list
+from .instance import get_instances
+from .metadata import get_region
+from .config import Config
+
+cfg = Config()
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('salt', 'ec2')
+
+
+def selector_to_compound(selector):
+    '''
+    :param selector: dict of grain -> value (or list of values), the same shape dict_to_grain_list takes
+    :return: salt compound target string
+    '''
+    return ' and '.join(dict_to_grain_list(selector))
+
+
+def selector_to_filters(selector, running_only=True):
+    '''
+    :param selector: dict of tag -> value (or list of values). Grains and tags share names in our fleet
+    :return: boto3 describe_instances filters
+    '''
+    filters = []
+    for k, v in sorted(selector.items()):
+        filters.append({'Name': 'tag:{k}'.format(k=k), 'Values': list(v) if isinstance(v, (list, tuple)) else [v]})
+
+    if running_only:
+        filters.append({'Name': 'instance-state-name', 'Values': ['running']})
+
+    return filters
+
+
+def salt_targets(selector):
+    '''
+    :return: dict of minion_id -> ip addresses, as find_minions returns them
+    '''
+    return find_minions(selector) or {}
+
+
+def ec2_targets(selector, regions=None):
+    '''
+    :return: List of InfraInstances whose tags match the selector
+    '''
+    return get_instances(regions or [get_region()], selector_to_filters(selector), concurrent=True)
+
+
+class TargetResolver(object):
+    """
+    Maps a grain/tag selector to a set of minions by asking salt (find_minions) and EC2 (tag filters) at the
+    same time and taking whichever complete answer comes back first. Salt publishes can take 5-10 seconds,
+    or time out entirely, on a busy master; EC2 usually answers in well under a second but knows nothing
+    about grains that aren't mirrored into tags.
+
+    Given a GrainIndex that isn't stale, selectors are answered from it locally (winner 'index') and
+    neither backend is asked at all. A stale index is refreshed in the background while that lookup (and any
+    others until the refresh lands) goes to the backends.
+
+    With cross_check=True both answers are waited on (up to the timeout) and any disagreement is logged and
+    counted. Every resolve records the winner in self.stats so defaults can be tuned from real numbers.
+    """
+    def __init__(self, regions=None, timeout=None, cross_check=False, backends=BACKENDS, index=None):
+        '''
+        :param regions: Regions to search in EC2. Defaults to the region we're running in
+        :param index: Optional GrainIndex to answer from while it's fresh
+        :param timeout: Seconds to wait for any answer
+        :param cross_check: Wait for both backends and compare
+        :param backends: Which backends to race
+        '''
+        self.regions = regions
+        self.timeout = timeout if timeout is not None else cfg.target_timeout
+        self.cross_check = cross_check
+        self.backends = backends
+        self.index = index
+
+        self._lock = threading.Lock()
+        self.stats = {
+            'resolves': 0,
+            'wins': dict((b, 0) for b in BACKENDS + ('index',)),
+            'failures': dict((b, 0) for b in BACKENDS),
+            'elapsed': dict((b, 0.0) for b in BACKENDS),
+            'mismatches': 0,
+            'index_refreshes': 0,
+        }
+
+    def __repr__(self):
+        return '<TargetResolver: {b}>'.format(b='/'.join(self.backends))
+
+    def _lookup(self, backend, selector):
+        start = time.time()
+        if backend == 'salt':
+            minions = set(salt_targets(selector))
+        else:
+            minions = set(i.name for i in ec2_targets(selector, self.regions))
+
+        return minions, time.time() - start
+
+    def resolve(self, selector):
+        '''
+        :param selector: dict of grain/tag -> value (or list of values)
+        :return: dict with the matched 'minions' (sorted list), the 'winner' backend, its 'elapsed' seconds
+            and, when cross checking, the per-backend 'answers' and whether they 'mismatch'
+        '''
+        if self.index is not None and self.index.is_stale():
+            if self.index.refresh_in_background() is not None:
+                self._count('index_refreshes')
+
+        if self.index is not None and not self.index.is_stale():
+            start = time.time()
+            minions = self.index.match(selector)
+            with self._lock:
+                self.stats['resolves'] += 1
+                self.stats['wins']['index'] += 1
+
+            return {'minions': sorted(minions), 'winner': 'index', 'elapsed': time.time() - start}
+
+        executor = ThreadPoolExecutor(max_workers=len(self.backends))
+        futures = dict((executor.submit(self._lookup, b, selector), b) for b in self.backends)
+        pending = set(futures)
+        answers = {}
+        winner = None
+        deadline = time.time() + self.timeout
+
+        try:
+            while pending and time.time() < deadline:
+                done, pending = wait(pending, timeout=max(0, deadline - time.time()), return_when=FIRST_COMPLETED)
+
+                for f in done:
+                    backend = futures[f]
+                    try:
+                        minions, elapsed = f.result()
+                    except Exception as e:
+                        logger.warning('%s target lookup failed: %s', backend, e)
+                        self._count('failures', backend)
+                        continue
+
+                    # an empty salt answer is as likely a publish timeout as a genuine "nothing matched"
+                    if not minions and backend == 'salt' and pending:
+                        logger.debug('salt found nothing, waiting on the other backend(s)')
+                        continue
+
+                    answers[backend] = (minions, elapsed)
+                    if winner is None:
+                        winner = backend
+
+                if winner is not None and not self.cross_check:
+                    break
+        finally:
+            for f in pending:
+                f.cancel()
+            executor.shutdown(wait=False)
+
+        if winner is None:
+            logger.error('No target backend answered for %s within %s seconds', selector, self.timeout)
+            return {'minions': [], 'winner': None, 'elapsed': None}
+
+        minions, elapsed = answers[winner]
+        result = {'minions': sorted(minions), 'winner': winner, 'elapsed': elapsed}
+
+        with self._lock:
+            self.stats['resolves'] += 1
+            self.stats['wins'][winner] += 1
+            self.stats['elapsed'][winner] += elapsed
+
+        logger.info('%s answered first (%.2fs, %d minion(s)) for %s', winner, elapsed, len(minions), selector)
+
+        if self.cross_check:
+            result['answers'] = dict((b, sorted(a[0])) for b, a in answers.items())
+            result['mismatch'] = len(set(frozenset(a[0]) for a in answers.values())) > 1
+
+            if result['mismatch']:
+                self._count('mismatches')
+                for b, a in answers.items():
+                    if b == winner:
+                        continue
+                    logger.warning('%s and %s disagree. Only %s: %s. Only %s: %s', winner, b,
+                                   winner, ', '.join(sorted(minions - a[0])) or '-',
+                                   b, ', '.join(sorted(a[0] - minions)) or '-')
+
+        return result
+
+    def _count(self, stat, backend=None):
+        with self._lock:
+            if backend is None:
+                self.stats[stat] += 1
+            else:
+                self.stats[stat][backend] += 1
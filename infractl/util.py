@@ -0,0 +1,152 @@
+import logging
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .exception import InfraCtlTimeoutException
+
+logger = logging.getLogger(__name__)
+
+
+def fan_out(items, func, max_workers=None, timeout=None, poll_interval=0.1):
+    '''
+    Run func(item) for every item on a bounded thread pool and yield (item, result, error) tuples in the order
+    they complete. Exactly one of result/error is meaningful for each tuple.
+
+    The timeout is applied per item, measured from when that item actually started running (not from when
+    it was queued). A timed out item is reported with an InfraCtlTimeoutException and abandoned - python
+    can't kill the worker thread, so it keeps its pool slot until func returns on its own.
+
+    Every completion rescans the pending futures, so this is meant for tens to hundreds of items (regions,
+    hosts). Use work_queue for file sized workloads.
+
+    :param items: iterable of work items
+    :param func: callable taking a single item
+    :param max_workers: Size of the pool. Defaults to one worker per item
+    :param timeout: Seconds any single item is allowed to run
+    :param poll_interval: How often to check for timed out items
+    :return: generator of (item, result, error)
+    '''
+    items = list(items)
+    if not items:
+        return
+
+    started = {}
+    lock = threading.Lock()
+
+    def run(idx, item):
+        with lock:
+            started[idx] = time.time()
+        return func(item)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(items))
+    futures = dict((executor.submit(run, idx, item), (idx, item)) for idx, item in enumerate(items))
+    pending = set(futures)
+
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=poll_interval if timeout else None, return_when=FIRST_COMPLETED)
+
+            for f in done:
+                _, item = futures[f]
+                try:
+                    result = f.result()
+                except Exception as e:
+                    yield item, None, e
+                else:
+                    yield item, result, None
+
+            if not timeout:
+                continue
+
+            now = time.time()
+            for f in list(pending):
+                idx, item = futures[f]
+                with lock:
+                    start = started.get(idx)
+
+                if start is not None and now - start > timeout:
+                    pending.discard(f)
+                    yield item, None, InfraCtlTimeoutException('{i} did not finish within {t} seconds'.format(
+                        i=item, t=timeout))
+    finally:
+        for f in pending:
+            f.cancel()
+        executor.shutdown(wait=False)
+
+
+def work_queue(items, func, workers):
+    '''
+    Like fan_out, but for large item counts (tens of thousands of files): a fixed set of worker threads pulls
+    items off a queue, so scheduling stays constant per item where fan_out rescans every pending future after
+    each completion. No per item timeout. Each worker keeps its own thread for the whole run, so func can
+    hang per thread state (an SFTP channel, say) off a threading.local.
+
+    :param items: iterable of work items
+    :param func: callable taking a single item
+    :param workers: Number of threads
+    :return: generator of (item, result, error) in completion order
+    '''
+    items = list(items)
+    if not items:
+        return
+
+    todo = queue.Queue()
+    for item in items:
+        todo.put(item)
+
+    done = queue.Queue()
+    stop = threading.Event()
+
+    def worker():
+        while not stop.is_set():
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                done.put((item, func(item), None))
+            except Exception as e:
+                done.put((item, None, e))
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        for _ in range(len(items)):
+            yield done.get()
+    finally:
+        # stops handing out work if the caller bails early; items already running finish in the background
+        stop.set()
+
+
+def backoff_delay(attempt, base=1, cap=30):
+    '''
+    Exponential backoff with jitter: half of the capped exponential delay is fixed, the other half random,
+    so a fleet of pollers spreads out without ever retrying immediately.
+    :param attempt: 0 based attempt number
+    :param base: Delay in seconds for the first attempt
+    :param cap: Upper bound on the delay
+    :return: float seconds to sleep
+    '''
+    delay = min(cap, base * (2 ** attempt))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def chunks(items, size):
+    '''
+    Split a sequence into lists of at most size items
+    '''
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
@@ -2,10 +2,8 @@
 import logging
 import threading
 import sys, os
-import json
 import argparse
 import boto3
-import subprocess
 import time
 import salt.client
 import pprint
@@ -14,6 +12,8 @@ pp = pprint.PrettyPrinter(indent=4)
 
 import infractl.instance as jinst
 import infractl.sodium as jsalt
+import infractl.metadata as jmeta
+import infractl.targeting as jtarget
 
 
 
@@ -30,49 +30,23 @@ caller = salt.client.Caller()
 ## this function is duplicated in the resumator salt runner.
 ## Those modules are only available on the salt-master.
 def get_region():
-    retry   = 3
-    counter = 0
-    global REGION
-    if REGION: return REGION
-
-    cmd = ('curl', 'http://169.254.169.254/latest/dynamic/instance-identity/document')
-    cmd = ' '.join(cmd)
-
-    while (counter < retry):
-        counter = counter + 1
-        logger.info("Running: {0}".format(cmd))
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        proc.wait()
-
-        if proc.returncode != 0:
-            logger.error('{0}/{1}: {2}'.format(counter, retry, proc.stderr.readlines()))
-            time.sleep(1)
-            continue
-
-        data = json.loads(proc.stdout.read().strip())
-
-        try:
-            REGION = data['region']
-            logger.debug("Obtained region: {0}".format(REGION))
-            return REGION
-        except KeyError:
-            logger.error('{0}/{1}: {2}'.format(counter, retry, 'Unable to get the region'))
-            time.sleep(1)
-            continue
-
-    return False
+    region = jmeta.get_region()
+
+    if not region:
+        logger.error('Unable to get the region')
+        return False
+
+    logger.debug("Obtained region: {0}".format(region))
+    return region
 
 def get_instances_non_salt(*instance_names, **filters):
-    ec2 = boto.ec2.connect_to_region(get_region())
     if filters:
-        reservations = ec2.get_all_instances(filters=filters)
+        return jtarget.ec2_targets(filters, [get_region()])
     elif instance_names:
-        reservations = ec2.get_all_instances(filters={'tag:Name':list(instance_names)})
+        return jtarget.ec2_targets({'Name': list(instance_names)}, [get_region()])
     else:
         return []
 
-    return [i for r in reservations for i in r.instances]
-
 def get_instances_old(target="'*'", target_type='grains', non_salt=False):
     counter = 1
     retry = 3
@@ -102,7 +76,7 @@ def __get_instances(target, target_type, non_salt):
         instances   = {}
 
         for i in insts:
-            instances[i.tags.get('Name')] = [i.private_ip_address]
+            instances[i.name] = [i.private_ip_address]
     else:
         logger.info("Getting instances targeting: {0}".format(target))
         expr_form       = 'compound' if target_type == 'grains' else 'glob'
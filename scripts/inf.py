@@ -1,4 +1,67 @@
+import sys
+import json
+import logging
+import argparse
+
+import infractl.awsgeneral as jaws
+from infractl.connection import setSessionProfile
+
+logger = logging.getLogger(__name__)
+
+
+def tags_reconcile(args):
+    report = jaws.reconcile_cost_tags(args.regions, dry_run=args.dry_run)
+
+    print(json.dumps(report, indent=4, sort_keys=True))
+
+    if report['failed_regions'] or report.get('result', {}).get('failed'):
+        return 1
+
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Infrastructure utilities.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-P', '--profile', dest='profile', type=str, required=False,
+                        help='The boto profile to use.')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='Log at DEBUG instead of INFO.')
+
+    sub = parser.add_subparsers(dest='command')
+
+    tags = sub.add_parser('tags', help='Cost allocation tagging')
+    tags_sub = tags.add_subparsers(dest='tags_command')
+
+    reconcile = tags_sub.add_parser('reconcile', help='Sync cost allocation tags on instances and volumes from grains',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    reconcile.add_argument('-r', '--regions', dest='regions', nargs='+', required=True,
+                           help='The regions to reconcile.')
+    reconcile.add_argument('-n', '--dry-run', dest='dry_run', action='store_true',
+                           help="Only report what would change.")
+    reconcile.set_defaults(func=tags_reconcile)
+
+    args = parser.parse_args(argv)
+
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        sys.exit(1)
+
+    return args
 
 
 def main():
-    print('About as simple as it gets...')
+    args = parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(levelname)s: %(asctime)s: %(message)s",
+                        datefmt="%Y/%m/%d %I:%M:%S %p")
+
+    setSessionProfile(args.profile)
+
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
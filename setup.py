@@ -27,7 +27,8 @@ setup(
     install_requires=[
         'boto3',
         'psutil',
-        'paramiko'
+        'paramiko',
+        'requests'
     ],
     zip_safe=False,
     entry_points={
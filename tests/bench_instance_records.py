@@ -0,0 +1,58 @@
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from infractl.instance import InfraInstance, InstanceRecord
+
+# Compares construction time and memory of InfraInstance vs InstanceRecord for a synthetic inventory.
+# No AWS access needed - both are built from describe_instances shaped payloads.
+
+COUNT = int(os.environ.get('BENCH_COUNT', 20000))
+REGIONS = ('us-east-1', 'us-east-2', 'us-west-2', 'eu-west-1')
+
+
+def payload(n):
+    return {
+        'InstanceId': 'i-{n:017x}'.format(n=n),
+        'State': {'Code': 16, 'Name': 'running'},
+        'PrivateIpAddress': '10.{a}.{b}.{c}'.format(a=(n >> 16) & 255, b=(n >> 8) & 255, c=n & 255),
+        'RootDeviceName': '/dev/sda1',
+        'BlockDeviceMappings': [
+            {'DeviceName': '/dev/sda1', 'Ebs': {'VolumeId': 'vol-{n:017x}'.format(n=n), 'Status': 'attached'}}
+        ],
+        'Tags': [
+            {'Key': 'Name', 'Value': 'worker-{n}.staging'.format(n=n)},
+            {'Key': 'cost_center', 'Value': 'engineering'},
+            {'Key': 'environment', 'Value': 'staging'},
+            {'Key': 'role', 'Value': 'worker'},
+        ],
+    }
+
+
+def measure(label, build):
+    # payloads are generated inside the traced window, so they only count if the objects hang on to them
+    data = ((REGIONS[n % len(REGIONS)], payload(n)) for n in range(COUNT))
+
+    tracemalloc.start()
+    start = time.time()
+    objs = build(data)
+    elapsed = time.time() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('{label:16} {n} objects  {t:8.3f}s  {mb:8.1f} MB resident'.format(
+        label=label, n=len(objs), t=elapsed, mb=current / 1024.0 / 1024.0))
+    return objs
+
+
+full = measure('InfraInstance', lambda data: [InfraInstance(r, d['InstanceId'], data=d) for r, d in data])
+del full
+
+records = measure('InstanceRecord', lambda data: [InstanceRecord.from_data(r, d) for r, d in data])
+
+assert records[0].hostname.startswith('worker-0.')
+assert records[0].tag('role') == 'worker'
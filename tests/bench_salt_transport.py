@@ -0,0 +1,25 @@
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from infractl.saltclient import get_transport
+
+# Compares the salt CLI against the reused in-process LocalClient. Run this on a salt-master (as root):
+#   python tests/bench_salt_transport.py [target] [calls]
+
+TARGET = sys.argv[1] if len(sys.argv) > 1 else '*'
+CALLS = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+for name in ('subprocess', 'local'):
+    transport = get_transport(name)
+
+    start = time.time()
+    for _ in range(CALLS):
+        res = transport.cmd(TARGET, 'test.ping')
+    elapsed = time.time() - start
+
+    print('{name:12} {n} calls  {t:8.3f}s total  {per:6.3f}s/call  {m} minion(s)'.format(
+        name=name, n=CALLS, t=elapsed, per=elapsed / CALLS, m=len(res)))
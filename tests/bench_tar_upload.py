@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+import collections
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from infractl.ssh import InfraCtlSshClient, InfraCtlSFTPClient
+
+# Compares per-file SFTP uploads with the tar stream modes. Needs a reachable host and a local tree to push:
+#   python tests/bench_tar_upload.py <host> <local dir> [remote scratch dir] [keyfile]
+# The remote scratch dir is removed before every run.
+
+HOST = sys.argv[1]
+SOURCE = sys.argv[2]
+TARGET = sys.argv[3] if len(sys.argv) > 3 else '/tmp/infractl-bench'
+KEYFILE = sys.argv[4] if len(sys.argv) > 4 else os.path.join(os.path.expanduser('~'), '.ssh', 'id_rsa')
+
+Host = collections.namedtuple('Host', 'hostname')
+
+jssh = InfraCtlSshClient(Host(HOST), user='root', keyfile=KEYFILE)
+assert jssh.wait_for_connection() is True
+
+jsftp = InfraCtlSFTPClient(Host(HOST), jssh)
+
+runs = [
+    ('sftp x1', dict(mode='sftp', workers=1)),
+    ('sftp', dict(mode='sftp')),
+    ('tar none', dict(mode='tar', compression='none')),
+    ('tar gzip', dict(mode='tar', compression='gzip')),
+    ('tar auto', dict(mode='tar', compression='auto')),
+]
+
+for name, kwargs in runs:
+    jssh.cmd('rm -rf {t}'.format(t=TARGET))
+
+    start = time.time()
+    res = jsftp.upload(SOURCE, TARGET, **kwargs)
+    elapsed = time.time() - start
+
+    print('{name:10} {f:7} files  {b:12} bytes  {t:8.2f}s  {r:8.2f} MB/s  {x} failed'.format(
+        name=name, f=res['files'], b=res['bytes'], t=elapsed, r=res['bytes'] / elapsed / 1e6, x=len(res['failed'])))
+
+jssh.cmd('rm -rf {t}'.format(t=TARGET))
+jsftp.close()
+jssh.close()
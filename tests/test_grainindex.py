@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import logging
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import infractl.grainindex as grainindex
+from infractl.grainindex import GrainIndex
+from infractl.sodium import dict_to_grain_list
+from infractl.saltclient import ReturnIter
+from infractl.targeting import TargetResolver, selector_to_compound
+
+logger      = logging.getLogger()
+loglevel = logging.INFO
+
+# controls logging for all inherited code
+format      = "%(levelname)s: %(asctime)s: %(message)s"
+dateformat  = "%Y/%m/%d %I:%M:%S %p"
+logger.setLevel(loglevel)
+sh          = logging.StreamHandler()
+formatter   = logging.Formatter(format, dateformat)
+
+sh.setLevel(loglevel)
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# Grain selectors, the local grain index and its refresh rules - no salt master required
+
+GRAINS = {
+    'web-01.prod': {'role': 'web', 'environment': 'prod', 'roles': ['web', 'cron']},
+    'api-01.prod': {'role': 'api', 'environment': 'prod', 'roles': ['api']},
+    'web-01.staging': {'role': 'web', 'environment': 'staging', 'roles': ['web']},
+}
+
+# Several values for one grain are OR'd, grains are AND'd
+assert dict_to_grain_list({'role': 'web'}) == ['G@role:web']
+assert dict_to_grain_list({'role': ['web']}) == ['G@role:web']
+assert dict_to_grain_list({'role': ['web', 'api']}) == ['( G@role:web or G@role:api )']
+assert dict_to_grain_list({'role': []}) == []
+assert selector_to_compound({'role': ['web', 'api'], 'environment': 'prod'}) == \
+    '( G@role:web or G@role:api ) and G@environment:prod'
+
+index = GrainIndex(ttl=60)
+for minion_id, grains in GRAINS.items():
+    index.update_minion(minion_id, grains)
+
+assert index.match({'role': 'web'}) == {'web-01.prod', 'web-01.staging'}
+assert index.match({'role': ['web', 'api'], 'environment': 'prod'}) == {'web-01.prod', 'api-01.prod'}
+assert index.match({'roles': 'cron'}) == {'web-01.prod'}
+assert index.match({'role': 'db'}) == set()
+assert index.match({'role': 'web', 'environment': 'dev'}) == set()
+assert index.match({}) == set(GRAINS)
+
+# Updates re-index, unchanged updates are no-ops, removals clean up after themselves
+assert index.update_minion('web-01.staging', GRAINS['web-01.staging']) is False
+assert index.update_minion('web-01.staging', {'role': 'api', 'environment': 'staging'}) is True
+assert index.match({'role': 'web'}) == {'web-01.prod'}
+index.remove_minion('api-01.prod')
+assert index.match({'role': 'api'}) == {'web-01.staging'}
+assert 'cron' in index.index['roles'] and 'api' not in index.index['roles']
+
+
+def fake_iter(returns, timed_out=False):
+    def salt_call_iter(target, method, args, expr_form, timeout=None):
+        it = ReturnIter(iter(returns))
+        it.timed_out = timed_out
+        return it
+    return salt_call_iter
+
+
+# Nobody answered / salt timed out: the index stays stale and isn't pruned
+index = GrainIndex(ttl=60)
+index.update_minion('web-01.prod', GRAINS['web-01.prod'])
+
+grainindex.salt_call_iter = fake_iter([])
+assert index.refresh(prune=True) == {'seen': 0, 'changed': 0, 'fresh': False}
+assert index.is_stale()
+assert index.match({'role': 'web'}) == {'web-01.prod'}
+
+grainindex.salt_call_iter = fake_iter([('api-01.prod', GRAINS['api-01.prod'])], timed_out=True)
+assert index.refresh(prune=True)['fresh'] is False
+assert index.is_stale()
+# whoever did answer is still folded in
+assert set(index.minions) == {'web-01.prod', 'api-01.prod'}
+
+grainindex.salt_call_iter = fake_iter(list(GRAINS.items()))
+assert index.refresh(prune=True) == {'seen': 3, 'changed': 1, 'fresh': True}
+assert not index.is_stale()
+
+# A stale index gets refreshed in the background and answers once it's fresh again
+index = GrainIndex(ttl=60)
+resolver = TargetResolver(index=index, backends=('salt',))
+resolver._lookup = lambda backend, selector: ({'from-salt'}, 0.01)
+
+res = resolver.resolve({'role': 'web'})
+assert res['winner'] == 'salt', res
+assert resolver.stats['index_refreshes'] == 1
+
+for _ in range(50):
+    if not index.is_stale():
+        break
+    time.sleep(0.1)
+
+res = resolver.resolve({'role': 'web'})
+assert res == {'minions': ['web-01.prod', 'web-01.staging'], 'winner': 'index', 'elapsed': res['elapsed']}, res
+
+print('ok')
@@ -0,0 +1,109 @@
+
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from infractl.metadata import MetadataClient
+
+logger      = logging.getLogger()
+loglevel = logging.INFO
+
+# controls logging for all inherited code
+format      = "%(levelname)s: %(asctime)s: %(message)s"
+dateformat  = "%Y/%m/%d %I:%M:%S %p"
+logger.setLevel(loglevel)
+sh          = logging.StreamHandler()
+formatter   = logging.Formatter(format, dateformat)
+
+sh.setLevel(loglevel)
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# A local stand in for the IMDSv2 endpoint - no AWS required
+
+TOKEN = 'test-token'
+DOCUMENT = {
+    'region': 'us-east-2',
+    'instanceId': 'i-0123456789abcdef0',
+    'accountId': '123456789012',
+}
+REQUESTS = []
+
+
+class FakeIMDS(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body=''):
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        REQUESTS.append(('PUT', self.path))
+        if self.path == '/latest/api/token' and self.headers.get('X-aws-ec2-metadata-token-ttl-seconds'):
+            return self._reply(200, TOKEN)
+        self._reply(400)
+
+    def do_GET(self):
+        REQUESTS.append(('GET', self.path))
+        if self.headers.get('X-aws-ec2-metadata-token') != TOKEN:
+            return self._reply(401)
+        if self.path == '/latest/dynamic/instance-identity/document':
+            return self._reply(200, json.dumps(DOCUMENT))
+        if self.path == '/latest/meta-data/instance-id':
+            return self._reply(200, DOCUMENT['instanceId'])
+        self._reply(404)
+
+
+server = HTTPServer(('127.0.0.1', 0), FakeIMDS)
+thread = threading.Thread(target=server.serve_forever)
+thread.daemon = True
+thread.start()
+
+base_url = 'http://127.0.0.1:{p}'.format(p=server.server_address[1])
+cache_dir = tempfile.mkdtemp()
+cache_path = os.path.join(cache_dir, 'identity.json')
+
+try:
+    meta = MetadataClient(base_url=base_url, cache_path=cache_path)
+
+    assert meta.region() == 'us-east-2'
+    assert meta.instance_id() == DOCUMENT['instanceId']
+    assert meta.account_id() == DOCUMENT['accountId']
+
+    # one token, one document fetch - everything after that is memoized
+    assert REQUESTS == [('PUT', '/latest/api/token'), ('GET', '/latest/dynamic/instance-identity/document')]
+
+    # the token is reused for other paths
+    assert meta.get('/latest/meta-data/instance-id') == DOCUMENT['instanceId']
+    assert [r for r in REQUESTS if r[0] == 'PUT'] == [('PUT', '/latest/api/token')]
+
+    # a fresh client (think: the next CLI run) is answered from the on-disk cache
+    del REQUESTS[:]
+    assert MetadataClient(base_url=base_url, cache_path=cache_path).identity() == DOCUMENT
+    assert REQUESTS == []
+
+    # ... unless told to refresh
+    assert MetadataClient(base_url=base_url, cache_path=cache_path).identity(refresh=True) == DOCUMENT
+    assert ('GET', '/latest/dynamic/instance-identity/document') in REQUESTS
+
+    # nothing listening: fail fast and quietly
+    dead = MetadataClient(base_url='http://127.0.0.1:1', cache_path=False, connect_timeout=0.2)
+    assert dead.identity() is None
+finally:
+    server.shutdown()
+    shutil.rmtree(cache_dir)
@@ -0,0 +1,191 @@
+
+import os
+import sys
+import time
+import logging
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import infractl.sodium as Na
+from infractl.saltclient import SaltTransport, LocalClientTransport, CallerTransport, set_transport
+
+logger      = logging.getLogger()
+loglevel = logging.INFO
+
+# controls logging for all inherited code
+format      = "%(levelname)s: %(asctime)s: %(message)s"
+dateformat  = "%Y/%m/%d %I:%M:%S %p"
+logger.setLevel(loglevel)
+sh          = logging.StreamHandler()
+formatter   = logging.Formatter(format, dateformat)
+
+sh.setLevel(loglevel)
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# Runs sodium against fake salt clients - no salt master required
+
+GRAINS = {
+    'web-01.staging': {'role': 'web', 'cost_center': 'eng', 'environment': 'staging'},
+    'web-02.staging': {'role': 'web', 'cost_center': 'eng', 'environment': 'staging'},
+}
+
+
+class FakeLocalClient(object):
+    def __init__(self):
+        self.calls = []
+
+    def _run(self, tgt, fun, arg, tgt_type):
+        assert tgt_type == 'list'
+        minions = tgt.split(',') if isinstance(tgt, str) else tgt
+        assert fun == 'grains.item'
+
+        return dict((m, dict((g, GRAINS[m].get(g, '')) for g in arg)) for m in minions if m in GRAINS)
+
+    def cmd(self, tgt, fun, arg=(), tgt_type='glob', timeout=None):
+        self.calls.append(('cmd', tgt, fun))
+        return self._run(tgt, fun, arg, tgt_type)
+
+    def cmd_iter(self, tgt, fun, arg=(), tgt_type='glob', timeout=None):
+        self.calls.append(('cmd_iter', tgt, fun))
+        for minion, ret in self._run(tgt, fun, arg, tgt_type).items():
+            yield {minion: {'ret': ret, 'retcode': 0}}
+
+    def run_job(self, tgt, fun, arg=(), tgt_type='glob', timeout=None):
+        self.calls.append(('run_job', tgt, fun))
+        jid = 'jid-{n}'.format(n=len(self.calls))
+        self.jobs = getattr(self, 'jobs', {})
+        self.jobs[jid] = self._run(tgt, fun, arg, tgt_type)
+        return {'jid': jid, 'minions': sorted(self.jobs[jid])}
+
+    def get_cache_returns(self, jid):
+        return dict((m, {'ret': r}) for m, r in self.jobs[jid].items())
+
+
+class FakeCaller(object):
+    def __init__(self):
+        self.calls = []
+
+    def function(self, fun, *args, **kwargs):
+        # publish.publish(tgt, fun, arg, tgt_type, returner, timeout): anything past tgt_type must be a keyword
+        assert len(args) <= 4, args
+        self.calls.append((fun,) + args + tuple(sorted(kwargs.items())))
+        return {'web-01.staging': ['10.0.0.1']}
+
+
+# A backend has to provide both cmd and cmd_iter
+
+
+class HalfTransport(SaltTransport):
+    def cmd(self, target, fun, args=(), tgt_type='glob', timeout=None, opts=None):
+        return {}
+
+
+try:
+    HalfTransport()
+    raise AssertionError('SaltTransport without cmd_iter was instantiated')
+except TypeError:
+    pass
+
+# Sodium through the in-process LocalClient and Caller backends
+
+Na.cfg.salt_cache_ttl = 0
+
+client = FakeLocalClient()
+set_transport(LocalClientTransport(client=client))
+
+try:
+    # one in-process call for every minion and grain
+    grains = Na.get_grains(['web-01.staging', 'web-02.staging', 'gone.staging'], ['role', 'cost_center'])
+    assert grains['web-01.staging'] == {'role': 'web', 'cost_center': 'eng'}
+    assert grains['gone.staging'] is None
+    assert len(client.calls) == 1
+
+    assert Na.get_grain_val('web-02.staging', 'environment') == 'staging'
+
+    # the same client is reused rather than rebuilt
+    assert len(client.calls) == 2
+
+    stream = Na.salt_call_iter(['web-01.staging', 'gone.staging'], 'grains.item', ['role'], 'list')
+    assert dict(stream) == {'web-01.staging': {'role': 'web'}}
+    assert stream.missing == ['gone.staging']
+
+    # a half read cmd_iter doesn't hold the transport's lock, other threads can still make calls
+    local = LocalClientTransport(client=client)
+    stream = local.cmd_iter(['web-01.staging', 'web-02.staging'], 'grains.item', ['role'], 'list')
+    pending = iter(stream)
+    next(pending)
+    other = threading.Thread(target=local.cmd, args=(['web-01.staging'], 'grains.item', ['role'], 'list'))
+    other.start()
+    other.join(5)
+    assert not other.is_alive()
+    assert len(dict(pending)) == 1
+    assert stream.missing == []
+
+    # a job whose target matches nobody is done straight away instead of sitting out its timeout
+    jobs = Na.SaltJobs(timeout=60, transport=LocalClientTransport(client=client), poll_interval=0.05)
+    hit = jobs.submit(['web-01.staging'], 'grains.item', ['role'], 'list')
+    miss = jobs.submit(['gone.staging'], 'grains.item', ['role'], 'list')
+    start = time.time()
+    results = jobs.gather()
+    assert time.time() - start < 5
+    assert results == {hit: {'web-01.staging': {'role': 'web'}}, miss: {}}, results
+
+    caller = FakeCaller()
+    ret = CallerTransport(caller=caller).cmd('G@role:web', 'network.ip_addrs', ['eth0'], 'compound')
+    assert ret == {'web-01.staging': ['10.0.0.1']}
+    assert caller.calls == [('publish.publish', 'G@role:web', 'network.ip_addrs', 'eth0', 'compound')]
+
+    CallerTransport(caller=caller).cmd('G@role:web', 'test.ping', timeout=60.0)
+    assert caller.calls[-1] == ('publish.publish', 'G@role:web', 'test.ping', '', 'glob', ('timeout', 60)), \
+        caller.calls[-1]
+finally:
+    set_transport(None)
+
+# Only read-only functions are cached, and only when every minion answered
+
+
+class CountingTransport(object):
+    def __init__(self, ret):
+        self.ret = ret
+        self.calls = 0
+
+    def cmd(self, target, fun, args=(), tgt_type='glob', timeout=None, opts=None):
+        self.calls += 1
+        return dict(self.ret)
+
+
+Na.cfg.salt_cache_ttl = 300
+Na.cache.invalidate()
+
+try:
+    transport = CountingTransport({'web-01.staging': {'role': 'web'}})
+    set_transport(transport)
+
+    Na.salt_call(['web-01.staging'], 'grains.item', ['role'], 'list')
+    Na.salt_call(['web-01.staging'], 'grains.item', ['role'], 'list')
+    assert transport.calls == 1
+
+    Na.salt_call(['web-01.staging'], 'cmd.run', ['service nginx reload'], 'list')
+    Na.salt_call(['web-01.staging'], 'cmd.run', ['service nginx reload'], 'list')
+    assert transport.calls == 3
+
+    # somebody didn't answer: not cached
+    transport = CountingTransport({'web-01.staging': {'role': 'web'},
+                                   'web-02.staging': 'Minion did not return. [No response]'})
+    set_transport(transport)
+    Na.salt_call(['web-01.staging', 'web-02.staging'], 'grains.item', ['cost_center'], 'list')
+    Na.salt_call(['web-01.staging', 'web-02.staging'], 'grains.item', ['cost_center'], 'list')
+    assert transport.calls == 2
+
+    # ...nor is a list target missing a minion altogether
+    transport = CountingTransport({'web-01.staging': {'role': 'web'}})
+    set_transport(transport)
+    Na.salt_call(['web-01.staging', 'gone.staging'], 'grains.item', ['environment'], 'list')
+    Na.salt_call(['web-01.staging', 'gone.staging'], 'grains.item', ['environment'], 'list')
+    assert transport.calls == 2
+finally:
+    Na.cfg.salt_cache_ttl = 0
+    Na.cache.invalidate()
+    set_transport(None)
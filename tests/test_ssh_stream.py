@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import logging
+import collections
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from infractl.ssh import InfraCtlSshClient, CommandOutput
+
+logger      = logging.getLogger()
+loglevel = logging.INFO
+
+# controls logging for all inherited code
+format      = "%(levelname)s: %(asctime)s: %(message)s"
+dateformat  = "%Y/%m/%d %I:%M:%S %p"
+logger.setLevel(loglevel)
+sh          = logging.StreamHandler()
+formatter   = logging.Formatter(format, dateformat)
+
+sh.setLevel(loglevel)
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# Runs InfraCtlSshClient.iter_cmd/cmd against fake paramiko channels - no ssh server required
+
+Host = collections.namedtuple('Host', 'hostname')
+
+
+class FakeChannel(object):
+    """
+    Hands out the given stdout chunks, then exits with exit_code. With endless=True stdout never runs dry
+    (think "yes" or "tail -f")
+    """
+    def __init__(self, chunks=(), exit_code=0, endless=False):
+        self.chunks = list(chunks)
+        self.exit_code = exit_code
+        self.endless = endless
+        self.closed = False
+        self.eof_received = False
+        self._pipe = os.pipe()
+
+    def exec_command(self, cmd):
+        self.cmd = cmd
+
+    def fileno(self):
+        return self._pipe[0]
+
+    def recv_ready(self):
+        return not self.closed and (self.endless or bool(self.chunks))
+
+    def recv(self, nbytes):
+        if self.endless:
+            return b'y\n' * 1000
+        return self.chunks.pop(0)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def exit_status_ready(self):
+        self.eof_received = not self.endless and not self.chunks
+        return self.eof_received
+
+    def recv_exit_status(self):
+        return self.exit_code
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for fd in self._pipe:
+            os.close(fd)
+
+
+class FakeClient(object):
+    def __init__(self, chan):
+        self.chan = chan
+
+    def get_transport(self):
+        return self
+
+    def open_session(self, timeout=None):
+        return self.chan
+
+
+def client_for(chan):
+    jssh = InfraCtlSshClient(Host('fake.host'), keyfile=os.devnull)
+    jssh.client = FakeClient(chan)
+    return jssh
+
+
+# A command that never stops printing still hits the timeout
+chan = FakeChannel(endless=True)
+start = time.time()
+res = client_for(chan).cmd('yes', timeout=1, max_bytes=1024)
+elapsed = time.time() - start
+
+assert res['exit_code'] == 255, res
+assert 'did not finish' in res['msg']['stderr']
+assert chan.closed
+assert elapsed < 3, elapsed
+
+# Regular output comes back in the clean_output shape, lines split across reads are put back together
+res = client_for(FakeChannel([b'one\ntw', b'o\nthree'], exit_code=3)).cmd('printf ...')
+assert res == {'exit_code': 3, 'msg': {'stdout': ['one', 'two', 'three'], 'stderr': []}}, res
+
+# Lines are handed to on_line as they arrive
+seen = []
+client_for(FakeChannel([b'a\n', b'b\n'])).cmd('x', on_line=lambda stream, line: seen.append((stream, line)))
+assert seen == [('stdout', 'a\n'), ('stdout', 'b\n')], seen
+
+# Walking away from iter_cmd early (break, then the generator is closed or collected) still closes the channel
+chan = FakeChannel(endless=True)
+lines = client_for(chan).iter_cmd('yes')
+assert next(lines) == ('stdout', 'y\n')
+assert not chan.closed
+lines.close()
+assert chan.closed
+
+# Past max_bytes output is dropped...
+out = CommandOutput('stdout', max_bytes=10)
+out.feed(b'12345\n12345\n12345\n')
+out.feed(b'', final=True)
+assert out.lines == ['12345\n'], out.lines
+assert out.truncated and out.path is None
+assert out.size == 18
+
+# The cap counts encoded bytes: 4 two byte characters plus the newline is 9 bytes, not 5 characters
+out = CommandOutput('stdout', max_bytes=10)
+out.feed(b'\xc3\xa9\xc3\xa9\xc3\xa9\xc3\xa9\n' * 2)
+out.feed(b'', final=True)
+assert len(out.lines) == 1 and out.truncated, out.lines
+assert out.size == 18
+
+res = client_for(FakeChannel([b'line\n' * 100])).cmd('x', max_bytes=20)
+assert res['truncated'] == ['stdout'], res
+assert len(res['msg']['stdout']) == 4
+
+# ...or spilled, with everything (not just the overflow) in the file
+out = CommandOutput('stdout', max_bytes=10, spill=True)
+out.feed(b'12345\n12345\n12345')
+out.feed(b'', final=True)
+assert not out.truncated
+with open(out.path) as fh:
+    assert fh.read() == '12345\n12345\n12345'
+os.unlink(out.path)
+
+res = client_for(FakeChannel([b'line\n' * 100])).cmd('x', max_bytes=20, spill=True)
+with open(res['spill']['stdout']) as fh:
+    assert len(fh.readlines()) == 100
+os.unlink(res['spill']['stdout'])
+
+print('ok')